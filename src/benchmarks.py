@@ -0,0 +1,507 @@
+import json
+import os
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cache
+import config
+import create_reports
+import llm
+import sweep
+
+
+class StubChatCompletionHandler(BaseHTTPRequestHandler):
+    """
+    A minimal stand-in for the OpenAI chat completion endpoint. It waits for server.latency seconds and then answers
+    with the content of the last user message, either as a single JSON response or as a server-sent event stream.
+
+    Failures can be injected: a fraction server.error_rate of the requests is answered with HTTP status
+    server.error_status (with a Retry-After header of server.retry_after seconds for 429), as are the first
+    server.fail_first requests, and a fraction server.slow_rate is delayed by server.slow_latency seconds instead of
+    server.latency.
+    """
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length))
+        with self.server.lock:
+            fail = self.server.random.random() < self.server.error_rate or self.server.requests < self.server.fail_first
+            slow = self.server.random.random() < self.server.slow_rate
+            self.server.requests += 1
+        time.sleep(self.server.slow_latency if slow else self.server.latency)
+
+        if fail:
+            body = json.dumps({"error": {"message": "Injected failure", "type": "server_error"}}).encode("utf-8")
+            self.send_response(self.server.error_status)
+            if self.server.error_status == 429 and self.server.retry_after is not None:
+                self.send_header("Retry-After", str(self.server.retry_after))
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        content = request["messages"][-1]["content"]
+
+        if request.get("stream"):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.end_headers()
+            for word in content.split(" "):
+                chunk = {"choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}]}
+                self.wfile.write(("data: " + json.dumps(chunk) + "\n\n").encode("utf-8"))
+            self.wfile.write(b"data: [DONE]\n\n")
+            return
+
+        body = json.dumps({
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}]
+        }).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(ThreadingHTTPServer):
+    """
+    The HTTP server of the stub endpoint. Its listen backlog is larger than any concurrency level the benchmarks use,
+    so that they measure the client and not connections refused or delayed by the default backlog of 5.
+    """
+    request_queue_size = 256
+
+
+def start_stub_server(latency=0.1, error_rate=0.0, error_status=500, retry_after=None, slow_rate=0.0,
+                      slow_latency=5.0, seed=0, fail_first=0):
+    """
+    Starts the stub chat completion server on a free local port in a background thread and points the openai client
+    at it. The failure injection settings are described in StubChatCompletionHandler; server.requests counts the
+    requests received. Returns the server; call server.shutdown() to stop it.
+    """
+    import openai
+
+    server = StubServer(("127.0.0.1", 0), StubChatCompletionHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.error_rate = error_rate
+    server.error_status = error_status
+    server.retry_after = retry_after
+    server.fail_first = fail_first
+    server.slow_rate = slow_rate
+    server.slow_latency = slow_latency
+    server.random = random.Random(seed)
+    server.lock = threading.Lock()
+    server.requests = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    openai.api_base = "http://127.0.0.1:" + str(server.server_address[1]) + "/v1"
+    os.environ.setdefault("OPENAI_API_KEY", "stub")
+    return server
+
+
+def benchmark_concurrent_evaluation(n_tests=50, latency=0.1, concurrency_levels=(1, 2, 4, 8, 16)):
+    """
+    Measures the wall-clock time of create_reports.evaluate_tests against the stub server for several max_workers
+    values. The cache is disabled so every test example is a real round-trip. Prints one line per concurrency level.
+    """
+    server = start_stub_server(latency)
+    prompt = [{"role": "system", "content": "Repeat the user message."}]
+    try:
+        baseline = None
+        for max_workers in concurrency_levels:
+            test = [{"input": "test sentence number " + str(i), "output": "test sentence number " + str(i)}
+                    for i in range(n_tests)]
+            start = time.perf_counter()
+            create_reports.evaluate_tests(None, prompt, test, "stub-model", "bleu", max_workers=max_workers)
+            elapsed = time.perf_counter() - start
+            if baseline is None:
+                baseline = elapsed
+            print(f"max_workers={max_workers:<3} {elapsed:.2f}s speedup={baseline / elapsed:.1f}x")
+    finally:
+        server.shutdown()
+
+
+def create_synthetic_cache(path, rows=100000, prompt_size=2000):
+    """
+    Fills a new completion cache database at the given path with rows of random prompts of about prompt_size
+    characters, in the legacy 'chat_completion' layout (without the key_hash column).
+    """
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE chat_completion (model TEXT, prompt TEXT, completion TEXT)")
+    rng = random.Random(0)
+    words = ["alpha", "beta", "gamma", "delta", "epsilon", "zeta", "eta", "theta"]
+    for start in range(0, rows, 10000):
+        batch = []
+        for i in range(start, min(start + 10000, rows)):
+            text = " ".join(rng.choice(words) for _ in range(prompt_size // 6))
+            messages = [{"role": "system", "content": "row " + str(i)}, {"role": "user", "content": text}]
+            batch.append(("gpt-3.5-turbo", json.dumps(messages, indent=4, ensure_ascii=False), text[:200]))
+        conn.executemany("INSERT INTO chat_completion (model, prompt, completion) VALUES (?, ?, ?)", batch)
+    conn.commit()
+    conn.close()
+
+
+def load_cache_as_dict(path):
+    """
+    The previous cache loader: reads every row of 'chat_completion' into a dictionary keyed by model and prompt.
+    """
+    res = {}
+    conn = sqlite3.connect(path)
+    for row in conn.execute("SELECT model, prompt, completion FROM chat_completion"):
+        res[row[0] + "\n" + row[1]] = row[2]
+    conn.close()
+    return res
+
+
+def benchmark_cache_cold_start(rows=100000, prompt_size=2000, lookups=1000):
+    """
+    Compares the cold-start time and the memory allocated by the dictionary loader and by cache.ChatCompletionCache
+    on a synthetic cache, followed by a number of random lookups. The first open of the cache, which backfills the
+    key_hash column of the legacy table once, is measured separately.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "llm_cache.sqlite3")
+        create_synthetic_cache(path, rows, prompt_size)
+        tracemalloc.start()
+        start = time.perf_counter()
+        cache.ChatCompletionCache(path).close()
+        first_open_time = time.perf_counter() - start
+        memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"indexed cache: first open with key_hash backfill {first_open_time:.3f}s  "
+              f"peak memory {memory / 2 ** 20:.1f} MiB")
+
+        conn = sqlite3.connect(path)
+        probes = conn.execute("SELECT model, prompt FROM chat_completion ORDER BY RANDOM() LIMIT ?",
+                              (lookups,)).fetchall()
+        conn.close()
+        probes = [(row[0], json.loads(row[1])) for row in probes]
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        loaded = load_cache_as_dict(path)
+        load_time = time.perf_counter() - start
+        for model, messages in probes:
+            loaded.get(cache.make_legacy_key(model, messages))
+        lookup_time = time.perf_counter() - start - load_time
+        memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del loaded
+        print(f"dict loader:  start {load_time:.3f}s  {lookups} lookups {lookup_time:.3f}s  "
+              f"peak memory {memory / 2 ** 20:.1f} MiB")
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        indexed = cache.ChatCompletionCache(path)
+        load_time = time.perf_counter() - start
+        for model, messages in probes:
+            indexed.get(model, messages, cache.LEGACY_PARAMETERS)
+        lookup_time = time.perf_counter() - start - load_time
+        memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        indexed.close()
+        print(f"indexed cache: start {load_time:.3f}s  {lookups} lookups {lookup_time:.3f}s  "
+              f"peak memory {memory / 2 ** 20:.1f} MiB")
+
+
+def benchmark_dataset_loading(languages=50, rows_per_language=2000, repetitions=10):
+    """
+    Compares selecting the train and test rows of every language configuration, repetitions times each, with the
+    full-table scan of create_reports.get_dataset and with the per-process cache of create_reports.load_dataset, on
+    a synthetic multi-language dataset.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "dataset.sqlite3")
+        conn = sqlite3.connect(path)
+        for table_name in ["train", "test"]:
+            conn.execute("CREATE TABLE " + table_name +
+                         " (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, parameters TEXT, input TEXT, output TEXT)")
+            conn.executemany("INSERT INTO " + table_name + " (name, parameters, input, output) VALUES (?, ?, ?, ?)",
+                             [("example_" + str(i), "language=language" + str(i % languages),
+                               "input sentence " + str(i), "output sentence " + str(i))
+                              for i in range(languages * rows_per_language)])
+        conn.commit()
+
+        configurations = [{"language": "language" + str(i)} for i in range(languages)]
+
+        start = time.perf_counter()
+        for parameters in configurations:
+            for q in range(repetitions):
+                for table_name in ["train", "test"]:
+                    create_reports.get_dataset(conn.cursor(), table_name, parameters)
+        scan_time = time.perf_counter() - start
+        conn.close()
+
+        start = time.perf_counter()
+        for parameters in configurations:
+            for q in range(repetitions):
+                for table_name in ["train", "test"]:
+                    create_reports.load_dataset(None, table_name, parameters, path=path)
+        cached_time = time.perf_counter() - start
+
+        print(f"{languages} configurations x {repetitions} repetitions: scan {scan_time:.2f}s, "
+              f"cached {cached_time:.2f}s")
+
+
+def check_retry_policy(cooldown=0.5):
+    """
+    Checks the retry behaviour of llm.call_llm against the stub server and a failing backend, and raises an
+    AssertionError if it is wrong:
+
+    - a fatal error (HTTP 400) is raised after one request, and a bug in a backend (a KeyError) after one attempt;
+    - after a 429 with a Retry-After header, the retry waits at least that long;
+    - the circuit breaker opens after CIRCUIT_BREAKER_THRESHOLD consecutive failures, holds the next call back for
+      its cooldown and closes when that call succeeds.
+    """
+    import openai
+
+    retry_policy = dict(llm.RETRY_POLICY)
+    llm.RETRY_POLICY.update(base_delay=0.001, max_delay=0.01)
+    breaker = llm.circuit_breakers["stub-model"] = llm.CircuitBreaker(cooldown=cooldown)
+    messages = [{"role": "user", "content": "retry check"}]
+    try:
+        server = start_stub_server(0.01, error_rate=1.0, error_status=400)
+        try:
+            llm.call_llm(None, messages, model="stub-model", streaming=False)
+            raise AssertionError("A 400 response did not raise")
+        except openai.error.InvalidRequestError:
+            pass
+        server.shutdown()
+        assert server.requests == 1, f"A fatal error was retried: {server.requests} requests"
+
+        backend = llm.MockBackend(latency=0.0, respond=lambda messages: messages[-1]["missing"])
+        llm.set_backend("broken-model", backend)
+        try:
+            llm.call_llm(None, messages, model="broken-model", streaming=False)
+            raise AssertionError("A KeyError in the backend did not raise")
+        except KeyError:
+            pass
+        finally:
+            llm.set_backend("broken-model", None)
+        assert backend.calls == 1, f"A bug in the backend was retried: {backend.calls} attempts"
+        assert llm.get_circuit_breaker("broken-model").failures == 0, "A bug in the backend tripped the circuit"
+
+        server = start_stub_server(0.01, error_status=429, retry_after=0.5, fail_first=1)
+        start = time.perf_counter()
+        llm.call_llm(None, messages, model="stub-model", streaming=False)
+        elapsed = time.perf_counter() - start
+        server.shutdown()
+        assert server.requests == 2, f"Expected one retry after a 429, got {server.requests} requests"
+        assert elapsed >= 0.5, f"Retry-After of 0.5s not respected: retried after {elapsed:.3f}s"
+
+        llm.RETRY_POLICY.update(max_attempts=llm.CIRCUIT_BREAKER_THRESHOLD)
+        server = start_stub_server(0.01, error_status=500, fail_first=llm.CIRCUIT_BREAKER_THRESHOLD)
+        try:
+            llm.call_llm(None, messages, model="stub-model", streaming=False)
+            raise AssertionError("Persistent 500 responses did not raise")
+        except openai.error.APIError:
+            pass
+        assert breaker.opened_at is not None, "The circuit did not open after consecutive failures"
+        start = time.perf_counter()
+        llm.call_llm(None, messages, model="stub-model", streaming=False)
+        elapsed = time.perf_counter() - start
+        server.shutdown()
+        assert elapsed >= cooldown * 0.9, f"The open circuit let a request through after {elapsed:.3f}s"
+        assert breaker.opened_at is None, "The circuit did not close after a successful probe"
+        print("Retry policy checks passed")
+    finally:
+        llm.RETRY_POLICY.update(retry_policy)
+        llm.circuit_breakers.pop("stub-model", None)
+
+
+def benchmark_retry_policy(n_calls=200, max_workers=8, error_rate=0.3, slow_rate=0.05, slow_latency=2.0,
+                           hedge_after=0.3):
+    """
+    Runs llm.call_llm against the stub server with injected failures and a slow tail, without cache. Prints how many
+    calls succeeded and how many requests they took with 500 and with 429 + Retry-After failures, then the median and
+    95th percentile latency of the slow-tail server with and without hedged requests.
+    """
+    retry_policy = dict(llm.RETRY_POLICY)
+    llm.RETRY_POLICY.update(base_delay=0.05, max_delay=1.0)
+    llm.circuit_breakers["stub-model"] = llm.CircuitBreaker(cooldown=1.0)
+
+    def run(server, **kwargs):
+        latencies = []
+
+        def call(i):
+            start = time.perf_counter()
+            try:
+                llm.call_llm(None, [{"role": "user", "content": "call number " + str(i)}], model="stub-model",
+                             streaming=False, **kwargs)
+            except Exception:
+                return False
+            latencies.append(time.perf_counter() - start)
+            return True
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            successes = sum(executor.map(call, range(n_calls)))
+        latencies.sort()
+        return successes, server.requests, time.perf_counter() - start, latencies
+
+    try:
+        for error_status, retry_after in ((500, None), (429, 0.2)):
+            server = start_stub_server(0.01, error_rate=error_rate, error_status=error_status, retry_after=retry_after)
+            successes, requests, elapsed, _ = run(server)
+            server.shutdown()
+            print(f"Status {error_status} at rate {error_rate}: {successes}/{n_calls} calls succeeded with "
+                  f"{requests} requests in {elapsed:.2f}s")
+
+        for hedge in (None, hedge_after):
+            server = start_stub_server(0.05, slow_rate=slow_rate, slow_latency=slow_latency)
+            successes, requests, elapsed, latencies = run(server, hedge_after=hedge)
+            server.shutdown()
+            print(f"Hedge after {hedge}: {requests} requests, median latency {latencies[len(latencies) // 2]:.3f}s, "
+                  f"p95 latency {latencies[int(len(latencies) * 0.95)]:.3f}s, total {elapsed:.2f}s")
+    finally:
+        llm.RETRY_POLICY.update(retry_policy)
+
+
+class OfflineWorkspace:
+    """
+    Context manager that copies the dataset and system messages of a project into a temporary data directory and
+    makes it the data directory (see config.set_data_dir). Reports, report stores, caches and sweep checkpoints
+    written inside it are discarded on exit.
+    """
+
+    def __init__(self, project):
+        self.project = project
+
+    def __enter__(self):
+        self.directory = tempfile.TemporaryDirectory()
+        source = config.data_path(self.project)
+        target = os.path.join(self.directory.name, self.project)
+        os.makedirs(os.path.join(target, "reports"))
+        shutil.copy(os.path.join(source, "dataset.sqlite3"), target)
+        shutil.copytree(os.path.join(source, "system"), os.path.join(target, "system"))
+        self.data_dir = config.data_dir
+        config.set_data_dir(self.directory.name)
+        return self
+
+    def __exit__(self, *args):
+        config.set_data_dir(self.data_dir)
+        self.directory.cleanup()
+
+
+def benchmark_offline_suite(project="grammar_correction", system_message_files=("1", "2"),
+                            parameters=None, ks=(0, 500), n=2, max_workers=8, latency=0.02, chunk_rate=500,
+                            hit_repeats=2000):
+    """
+    End-to-end benchmarks of the hot path with llm.MockBackend instead of the API, so they run without network and
+    can be compared between commits. In an OfflineWorkspace, it measures:
+
+    create_report: the wall-clock time and test examples per second of one report with a cold cache, and again with
+        every call a cache hit.
+    cache hit: the cost of one llm.call_llm cache hit, telemetry included, averaged over hit_repeats calls.
+    sweep: the wall-clock time of sweep.run_sweep over system_message_files x ks with n repetitions, and of
+        resuming the finished sweep.
+
+    Returns:
+    dict: The measured numbers, also printed.
+    """
+    parameters = parameters or {"language": "English"}
+    model = "mock-model"
+    backend = llm.MockBackend(latency=latency, chunk_rate=chunk_rate)
+    llm.set_backend(model, backend)
+    res = {}
+    try:
+        with OfflineWorkspace(project):
+            for phase in ("cold", "warm"):
+                start = time.perf_counter()
+                create_reports.create_report(project, model, system_message_files[0], parameters, ks[-1], "bleu",
+                                             max_workers=max_workers)
+                elapsed = time.perf_counter() - start
+                n_tests = len(create_reports.load_dataset(project, "test", parameters))
+                res["create_report_" + phase + "_seconds"] = elapsed
+                res["create_report_" + phase + "_tests_per_second"] = n_tests / elapsed
+
+            completion_cache = llm.get_chat_completion_cache()
+            prompt, test = create_reports.build_prompt(project, system_message_files[0], parameters, ks[-1])
+            messages = prompt + [{"role": "user", "content": test[0]["input"]}]
+            llm.call_llm(completion_cache, messages, model=model, temperature=create_reports.TEMPERATURE,
+                         max_tokens=create_reports.MAX_TOKENS)
+            start = time.perf_counter()
+            for _ in range(hit_repeats):
+                llm.call_llm(completion_cache, messages, model=model, temperature=create_reports.TEMPERATURE,
+                             max_tokens=create_reports.MAX_TOKENS)
+            res["cache_hit_microseconds"] = (time.perf_counter() - start) / hit_repeats * 1e6
+            completion_cache.close()
+
+            spec = {
+                "project": project,
+                "system_message_files": list(system_message_files),
+                "models": [model],
+                "parameters": [parameters],
+                "ks": list(ks),
+                "metric": "bleu",
+                "n": n
+            }
+            calls = backend.calls
+            start = time.perf_counter()
+            sweep.run_sweep([spec], max_workers=max_workers)
+            res["sweep_seconds"] = time.perf_counter() - start
+            res["sweep_calls"] = backend.calls - calls
+            start = time.perf_counter()
+            sweep.run_sweep([spec], max_workers=max_workers)
+            res["sweep_resume_seconds"] = time.perf_counter() - start
+    finally:
+        llm.set_backend(model, None)
+
+    print(f"create_report: cold {res['create_report_cold_seconds']:.2f}s "
+          f"({res['create_report_cold_tests_per_second']:.1f} tests/s), warm {res['create_report_warm_seconds']:.3f}s "
+          f"({res['create_report_warm_tests_per_second']:.1f} tests/s)")
+    print(f"cache hit: {res['cache_hit_microseconds']:.1f}us per call_llm")
+    print(f"sweep: {res['sweep_calls']} calls in {res['sweep_seconds']:.2f}s, resumed in "
+          f"{res['sweep_resume_seconds']:.3f}s")
+    return res
+
+
+def benchmark_cli_startup(repetitions=5):
+    """
+    Measures the startup time of every prompt_gpt subcommand: a fresh interpreter that imports prompt_gpt and the
+    modules the subcommand imports (prompt_gpt.SUBCOMMAND_MODULES), best of repetitions runs. Prints the time, the
+    heavy packages that got imported and whether prompt_gpt.STARTUP_TARGET_SECONDS is met.
+
+    Returns:
+    dict: The startup time of each subcommand in seconds, and of the bare "prompt_gpt" import.
+    """
+    import prompt_gpt
+
+    heavy = ["openai", "nltk", "numpy", "matplotlib"]
+    source_directory = os.path.dirname(os.path.abspath(__file__))
+    res = {}
+    for subcommand, modules in [("prompt_gpt", [])] + list(prompt_gpt.SUBCOMMAND_MODULES.items()):
+        code = ("import sys; import prompt_gpt; " + "".join("import " + module + "; " for module in modules) +
+                "print(','.join(name for name in " + repr(heavy) + " if name in sys.modules))")
+        times = []
+        for _ in range(repetitions):
+            start = time.perf_counter()
+            loaded = subprocess.run([sys.executable, "-c", code], cwd=source_directory, capture_output=True,
+                                    text=True, check=True).stdout.strip()
+            times.append(time.perf_counter() - start)
+        res[subcommand] = min(times)
+        print(f"{subcommand:<11} {res[subcommand]:.3f}s "
+              f"{'ok' if res[subcommand] <= prompt_gpt.STARTUP_TARGET_SECONDS else 'OVER TARGET'} "
+              f"imports: {loaded or '-'}")
+    return res
+
+
+if __name__ == "__main__":
+    benchmark_concurrent_evaluation()
+    benchmark_cache_cold_start()
+    benchmark_dataset_loading()
+    check_retry_policy()
+    benchmark_retry_policy()
+    benchmark_offline_suite()
+    benchmark_cli_startup()
@@ -0,0 +1,559 @@
+import atexit
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Message bodies and completions longer than this many bytes are stored zlib-compressed.
+COMPRESSION_THRESHOLD = 512
+
+
+# Version of the cache key built by make_key. Version 1 keys covered only the model and the messages.
+KEY_VERSION = 2
+
+# The call parameters every version 1 entry was created with. Version 1 entries are only returned for these.
+LEGACY_PARAMETERS = {"temperature": 0.0, "max_tokens": 2000}
+
+
+# The columns of the telemetry table, in the order of the records written by llm.call_llm.
+TELEMETRY_COLUMNS = [
+    ("key_hash", "TEXT"),
+    ("model", "TEXT"),
+    ("timestamp", "REAL"),
+    ("cache_hit", "INTEGER"),
+    ("ttft", "REAL"),
+    ("latency", "REAL"),
+    ("prompt_tokens", "INTEGER"),
+    ("completion_tokens", "INTEGER"),
+    ("attempts", "INTEGER"),
+]
+
+
+# The types call parameters are converted to before they enter a cache key, so that temperature=0 and
+# temperature=0.0 share one key.
+PARAMETER_TYPES = {"temperature": float, "max_tokens": int}
+
+
+def normalize_parameters(parameters):
+    """
+    Returns a copy of call parameters with the values listed in PARAMETER_TYPES converted to their canonical type.
+    """
+    if parameters is None:
+        return None
+    return {name: PARAMETER_TYPES[name](value) if name in PARAMETER_TYPES and value is not None else value
+            for name, value in parameters.items()}
+
+
+def make_key(model, messages, parameters):
+    """
+    Builds the cache key of a chat completion request. The key covers the key version, the model name, the messages
+    and all call parameters that affect the completion (such as temperature and max_tokens), normalized with
+    normalize_parameters.
+    """
+    return "v" + str(KEY_VERSION) + "\n" + json.dumps({"model": model, "messages": messages,
+                                                      "parameters": normalize_parameters(parameters)},
+                                                     sort_keys=True, ensure_ascii=False)
+
+
+def make_legacy_key(model, messages):
+    """
+    Builds the version 1 cache key: the model name and the pretty-printed JSON of the messages separated by a newline
+    character ("\n"). Entries written before the key covered the call parameters are stored under this key.
+    """
+    return model + "\n" + json.dumps(messages, indent=4, ensure_ascii=False)
+
+
+def hash_key(key):
+    """
+    Returns the SHA-256 hex digest of a cache key or of a message body.
+    """
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def pack_text(text):
+    """
+    Encodes a string for storage. Returns a (blob, compressed) tuple, where compressed is 1 if the blob is
+    zlib-compressed and 0 if it is plain UTF-8.
+    """
+    data = text.encode("utf-8")
+    if len(data) > COMPRESSION_THRESHOLD:
+        compressed = zlib.compress(data, 6)
+        if len(compressed) < len(data):
+            return compressed, 1
+    return data, 0
+
+
+def unpack_text(blob, compressed):
+    """
+    Decodes a (blob, compressed) pair produced by pack_text.
+    """
+    if isinstance(blob, str):
+        return blob
+    if compressed:
+        blob = zlib.decompress(blob)
+    return blob.decode("utf-8")
+
+
+def create_tables(conn):
+    """
+    Creates the content-addressed cache tables if they do not exist:
+
+    message_body: every distinct message content once, under its SHA-256 hash.
+    completion: one row per cached request, keyed by the hash of the cache key. The prompt is stored as the JSON list
+        of its messages with each content replaced by the hash of its body, next to the call parameters.
+    telemetry: one row per llm.call_llm call (see TELEMETRY_COLUMNS), indexed by the hash of the cache key.
+    """
+    conn.execute("CREATE TABLE IF NOT EXISTS message_body "
+                 "(hash TEXT PRIMARY KEY, body BLOB, compressed INTEGER)")
+    conn.execute("CREATE TABLE IF NOT EXISTS completion "
+                 "(key_hash TEXT PRIMARY KEY, model TEXT, messages TEXT, parameters TEXT, completion BLOB, "
+                 "compressed INTEGER)")
+    conn.execute("CREATE TABLE IF NOT EXISTS telemetry (id INTEGER PRIMARY KEY, " +
+                 ", ".join(column + " " + column_type for column, column_type in TELEMETRY_COLUMNS) + ")")
+    conn.execute("CREATE INDEX IF NOT EXISTS telemetry_key_hash ON telemetry (key_hash)")
+
+
+def encode_entry(key_hash, model, messages, completion, parameters=None):
+    """
+    Converts one cache entry into the rows stored by the content-addressed layout. Returns a (completion_row,
+    body_rows) tuple ready to be inserted into the 'completion' and 'message_body' tables.
+    """
+    body_rows = []
+    prompt = []
+    for message in messages:
+        body_hash = hash_key(message["content"])
+        body, compressed = pack_text(message["content"])
+        body_rows.append((body_hash, body, compressed))
+        prompt.append(dict(message, content=body_hash))
+    blob, compressed = pack_text(completion)
+    completion_row = (key_hash, model, json.dumps(prompt, separators=(",", ":")), json.dumps(parameters), blob,
+                      compressed)
+    return completion_row, body_rows
+
+
+def write_entries(conn, entries, telemetry=()):
+    """
+    Inserts encoded entries into the cache tables. Bodies and completions that are already stored are skipped.
+    Telemetry records (dictionaries with the TELEMETRY_COLUMNS keys) are appended to the telemetry table.
+    """
+    conn.executemany("INSERT INTO telemetry (" + ", ".join(column for column, _ in TELEMETRY_COLUMNS) + ") VALUES (" +
+                     ", ".join("?" for _ in TELEMETRY_COLUMNS) + ")",
+                     [tuple(record[column] for column, _ in TELEMETRY_COLUMNS) for record in telemetry])
+    conn.executemany("INSERT OR IGNORE INTO message_body (hash, body, compressed) VALUES (?, ?, ?)",
+                     [body_row for entry in entries for body_row in entry[1]])
+    conn.executemany("INSERT OR IGNORE INTO completion "
+                     "(key_hash, model, messages, parameters, completion, compressed) VALUES (?, ?, ?, ?, ?, ?)",
+                     [entry[0] for entry in entries])
+
+
+class CacheWriter:
+    """
+    Write-behind writer for the content-addressed cache tables. Completions and telemetry records are queued in
+    memory and written by a background thread in one transaction per batch, when batch_size rows are pending or
+    flush_interval seconds have passed since the oldest pending row was queued, and once more at interpreter exit. At
+    most the last unflushed batch is lost if the process crashes.
+
+    Writes take the database lock with BEGIN IMMEDIATE and wait up to busy_timeout seconds for it, and entries that
+    are already stored (for example by another process) are skipped, so several threads and processes can
+    share one cache file. Processes that exit without running atexit handlers, such as multiprocessing workers, must
+    call close() themselves.
+
+    Parameters:
+    path (str): The path of the SQLite3 database.
+    batch_size (int, optional): The number of pending rows that triggers a flush. Defaults to 64.
+    flush_interval (float, optional): The maximum age in seconds of a pending row. Defaults to 1.0.
+    busy_timeout (float, optional): How long to wait for the database lock, in seconds. Defaults to 30.0.
+    """
+
+    def __init__(self, path, batch_size=64, flush_interval=1.0, busy_timeout=30.0):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.conn = sqlite3.connect(path, timeout=busy_timeout, isolation_level=None, check_same_thread=False)
+        self.pending = OrderedDict()
+        self.telemetry = []
+        self.oldest = None
+        self.closed = False
+        self.condition = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def write(self, key_hash, model, messages, completion, parameters=None):
+        """
+        Queues one completion for writing. Returns immediately.
+        """
+        entry = encode_entry(key_hash, model, messages, completion, parameters)
+        with self.condition:
+            self.pending[key_hash] = (completion, entry)
+            self._queued()
+
+    def record(self, telemetry):
+        """
+        Queues one telemetry record for writing. Returns immediately.
+        """
+        with self.condition:
+            self.telemetry.append(telemetry)
+            self._queued()
+
+    def _queued(self):
+        if self.oldest is None:
+            self.oldest = time.monotonic()
+        if len(self.pending) + len(self.telemetry) >= self.batch_size:
+            self.condition.notify()
+
+    def lookup(self, key_hash):
+        """
+        Returns the completion queued under key_hash that has not been written yet, or None.
+        """
+        with self.condition:
+            row = self.pending.get(key_hash)
+        return None if row is None else row[0]
+
+    def lookup_telemetry(self, key_hash):
+        """
+        Returns the latest queued telemetry record of an API call (not a cache hit) under key_hash, or None.
+        """
+        with self.condition:
+            for record in reversed(self.telemetry):
+                if record["key_hash"] == key_hash and not record["cache_hit"]:
+                    return record
+        return None
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.closed and len(self.pending) + len(self.telemetry) < self.batch_size and \
+                        (self.oldest is None or time.monotonic() - self.oldest < self.flush_interval):
+                    timeout = self.flush_interval if self.oldest is None else \
+                        self.flush_interval - (time.monotonic() - self.oldest)
+                    self.condition.wait(timeout)
+                if self.closed:
+                    return
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Writing the cache failed, retrying in %.1f seconds", self.flush_interval)
+                with self.condition:
+                    self.condition.wait(self.flush_interval)
+
+    def flush(self):
+        """
+        Writes all queued completions and telemetry records to the database in a single transaction. If the write
+        fails, they stay queued and the error is raised; the background thread logs it and retries after
+        flush_interval seconds.
+        """
+        with self.flush_lock:
+            with self.condition:
+                rows = list(self.pending.items())
+                telemetry = self.telemetry
+                self.telemetry = []
+                self.oldest = None
+            if not rows and not telemetry:
+                return
+            try:
+                self.conn.execute("BEGIN IMMEDIATE")
+                try:
+                    write_entries(self.conn, [row[1][1] for row in rows], telemetry)
+                    self.conn.execute("COMMIT")
+                except Exception:
+                    self.conn.execute("ROLLBACK")
+                    raise
+            except Exception:
+                with self.condition:
+                    self.telemetry[:0] = telemetry
+                    if self.oldest is None:
+                        self.oldest = time.monotonic()
+                raise
+            with self.condition:
+                for key_hash, row in rows:
+                    if self.pending.get(key_hash) is row:
+                        del self.pending[key_hash]
+
+    def close(self):
+        """
+        Stops the background thread and flushes the remaining completions. Safe to call more than once.
+        """
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+        self.flush()
+        self.conn.close()
+        atexit.unregister(self.close)
+
+
+class ChatCompletionCache:
+    """
+    Completion cache stored in a SQLite3 database in a content-addressed layout (see create_tables): each message body
+    is saved once under its hash, a prompt is a list of message hashes plus the call parameters, and large bodies
+    and completions are compressed. Every lookup queries a single row by the hash of the cache key, which covers the
+    model, the messages and the call parameters (see make_key). A bounded LRU
+    dictionary of recently used completions sits in front of the database, and one long-lived connection in WAL
+    mode (or with a rollback journal if the data directory is shared, see config.get_journal_mode) is shared by all
+    threads.
+
+    Parameters:
+    path (str, optional): The path of the SQLite3 database. Defaults to llm_cache.sqlite3 in the data directory
+        (see config.get_data_dir).
+    lru_size (int, optional): The maximum number of completions kept in memory. Defaults to 4096.
+    batch_size (int, optional): The batch size of the background CacheWriter. Defaults to 64.
+    flush_interval (float, optional): The flush interval of the background CacheWriter in seconds. Defaults to 1.0.
+
+    Note:
+    New completions are written through a CacheWriter, so they reach the database in batches shortly after put()
+    returns. Call flush() to write them immediately.
+    Entries in a legacy 'chat_completion' table that has not been converted with migrate_chat_completion_table are
+    still found: the table gets an indexed 'key_hash' column on first open and is queried when the new tables miss.
+    """
+
+    def __init__(self, path=None, lru_size=4096, batch_size=64, flush_interval=1.0):
+        path = path or config.data_path("llm_cache.sqlite3")
+        self.path = path
+        self.lru_size = lru_size
+        self.lru = OrderedDict()
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30.0, check_same_thread=False)
+        journal_mode = config.get_journal_mode()
+        self.conn.execute("PRAGMA journal_mode=" + journal_mode)
+        if journal_mode == "WAL":
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+        create_tables(self.conn)
+        self.has_legacy_table = self._migrate_legacy_table()
+        self.conn.commit()
+        self.writer = CacheWriter(path, batch_size=batch_size, flush_interval=flush_interval)
+
+    def _migrate_legacy_table(self, batch_size=1000):
+        cursor = self.conn.cursor()
+        if cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'chat_completion'").fetchone() \
+                is None:
+            return False
+        columns = [row[1] for row in cursor.execute("PRAGMA table_info(chat_completion)")]
+        if "key_hash" not in columns:
+            cursor.execute("ALTER TABLE chat_completion ADD COLUMN key_hash TEXT")
+        # Backfill in batches by rowid, so that only batch_size prompts are in memory at a time.
+        last_rowid = -1
+        while True:
+            rows = cursor.execute("SELECT rowid, model, prompt FROM chat_completion "
+                                  "WHERE rowid > ? AND key_hash IS NULL ORDER BY rowid LIMIT ?",
+                                  (last_rowid, batch_size)).fetchall()
+            if not rows:
+                break
+            cursor.executemany("UPDATE chat_completion SET key_hash = ? WHERE rowid = ?",
+                               [(hash_key(row[1] + "\n" + row[2]), row[0]) for row in rows])
+            last_rowid = rows[-1][0]
+        cursor.execute("CREATE INDEX IF NOT EXISTS chat_completion_key_hash ON chat_completion (key_hash)")
+        return True
+
+    def _remember(self, key_hash, completion):
+        self.lru[key_hash] = completion
+        self.lru.move_to_end(key_hash)
+        if len(self.lru) > self.lru_size:
+            self.lru.popitem(last=False)
+
+    def _lookup(self, key_hash):
+        if key_hash in self.lru:
+            self.lru.move_to_end(key_hash)
+            return self.lru[key_hash]
+        completion = self.writer.lookup(key_hash)
+        if completion is not None:
+            return completion
+        row = self.conn.execute("SELECT completion, compressed FROM completion WHERE key_hash = ?",
+                                (key_hash,)).fetchone()
+        if row is not None:
+            completion = unpack_text(row[0], row[1])
+        elif self.has_legacy_table:
+            row = self.conn.execute("SELECT completion FROM chat_completion WHERE key_hash = ? LIMIT 1",
+                                    (key_hash,)).fetchone()
+            if row is not None:
+                completion = row[0]
+        if completion is not None:
+            self._remember(key_hash, completion)
+        return completion
+
+    def get(self, model, messages, parameters):
+        """
+        Returns the cached completion for the given model, messages and call parameters, or None if there is none.
+        Entries stored under a version 1 key are returned when the parameters equal LEGACY_PARAMETERS.
+        """
+        key_hash = hash_key(make_key(model, messages, parameters))
+        with self.lock:
+            completion = self._lookup(key_hash)
+            if completion is None and parameters == LEGACY_PARAMETERS:
+                completion = self._lookup(hash_key(make_legacy_key(model, messages)))
+            return completion
+
+    def put(self, model, messages, completion, parameters):
+        """
+        Stores the completion for the given model, messages and call parameters in the in-memory LRU and queues it
+        for writing to the database. The parameters are stored alongside the prompt.
+        """
+        key_hash = hash_key(make_key(model, messages, parameters))
+        with self.lock:
+            self._remember(key_hash, completion)
+        self.writer.write(key_hash, model, messages, completion, parameters)
+
+    def record_telemetry(self, telemetry):
+        """
+        Queues a telemetry record of llm.call_llm (a dictionary with the TELEMETRY_COLUMNS keys) for writing to the
+        telemetry table.
+        """
+        self.writer.record(telemetry)
+
+    def lookup_telemetry(self, key_hash):
+        """
+        Returns the telemetry of the latest API call that produced the completion under key_hash, as a dictionary
+        with the TELEMETRY_COLUMNS keys, or None if it was not recorded.
+        """
+        record = self.writer.lookup_telemetry(key_hash)
+        if record is not None:
+            return record
+        with self.lock:
+            row = self.conn.execute("SELECT " + ", ".join(column for column, _ in TELEMETRY_COLUMNS) +
+                                    " FROM telemetry WHERE key_hash = ? AND cache_hit = 0 ORDER BY id DESC LIMIT 1",
+                                    (key_hash,)).fetchone()
+        return None if row is None else {column: row[i] for i, (column, _) in enumerate(TELEMETRY_COLUMNS)}
+
+    def flush(self):
+        """
+        Writes all queued completions and telemetry records to the database.
+        """
+        self.writer.flush()
+
+    def __len__(self):
+        with self.lock:
+            res = self.conn.execute("SELECT COUNT(*) FROM completion").fetchone()[0]
+            if self.has_legacy_table:
+                res += self.conn.execute("SELECT COUNT(*) FROM chat_completion").fetchone()[0]
+            return res
+
+    def close(self):
+        """
+        Flushes the queued completions and closes the database connections.
+        """
+        self.writer.close()
+        with self.lock:
+            self.conn.close()
+
+
+def get_cache_stats(path=None):
+    """
+    Reads summary statistics of a cache database without opening it for writing.
+
+    Parameters:
+    path (str, optional): The path of the SQLite3 database. Defaults to llm_cache.sqlite3 in the data directory.
+
+    Returns:
+    dict: The "path", the "file_bytes" of the database and its WAL file, the number of "completions" (plus
+    "legacy_completions" not yet migrated), "message_bodies" and "compressed_completions", the "stored_text_bytes"
+    of bodies and completions, the number of "telemetry_records", and per model in "models" its "completions",
+    recorded API "calls" and "cache_hits", and "average_latency" in seconds. All counts are 0 if the database does
+    not exist yet.
+    """
+    from urllib.request import pathname2url
+
+    path = path or config.data_path("llm_cache.sqlite3")
+    res = {"path": path, "file_bytes": sum(os.path.getsize(file_path) for file_path in (path, path + "-wal")
+                                           if os.path.exists(file_path))}
+    if os.path.exists(path):
+        conn = sqlite3.connect("file:" + pathname2url(os.path.abspath(path)) + "?mode=ro", uri=True)
+        tables = set(row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'"))
+    else:
+        conn = None
+        tables = set()
+
+    def count(sql):
+        return conn.execute(sql).fetchone()[0] or 0
+
+    res["completions"] = count("SELECT COUNT(*) FROM completion") if "completion" in tables else 0
+    res["legacy_completions"] = count("SELECT COUNT(*) FROM chat_completion") if "chat_completion" in tables else 0
+    res["message_bodies"] = count("SELECT COUNT(*) FROM message_body") if "message_body" in tables else 0
+    res["compressed_completions"] = count("SELECT COUNT(*) FROM completion WHERE compressed = 1") \
+        if "completion" in tables else 0
+    res["stored_text_bytes"] = (count("SELECT SUM(LENGTH(body)) FROM message_body") if "message_body" in tables
+                                else 0) + (count("SELECT SUM(LENGTH(completion)) FROM completion")
+                                           if "completion" in tables else 0)
+    res["telemetry_records"] = count("SELECT COUNT(*) FROM telemetry") if "telemetry" in tables else 0
+    models = {}
+    if "completion" in tables:
+        for model, completions in conn.execute("SELECT model, COUNT(*) FROM completion GROUP BY model"):
+            models[model] = {"completions": completions, "calls": 0, "cache_hits": 0, "average_latency": None}
+    if "telemetry" in tables:
+        for model, calls, cache_hits, average_latency in conn.execute(
+                "SELECT model, SUM(1 - cache_hit), SUM(cache_hit), AVG(CASE WHEN cache_hit = 0 THEN latency END) "
+                "FROM telemetry GROUP BY model"):
+            models.setdefault(model, {"completions": 0}).update(calls=calls, cache_hits=cache_hits,
+                                                                 average_latency=average_latency)
+    res["models"] = models
+    if conn is not None:
+        conn.close()
+    return res
+
+
+def migrate_chat_completion_table(path=None, batch_size=1000):
+    """
+    Converts the legacy 'chat_completion' table, which stores the full pretty-printed prompt of every request, into
+    the content-addressed tables, drops it and compacts the database file. The rows keep their version 1 key hash.
+    Prints and returns the size reduction.
+
+    Returns:
+    dict: The number of migrated rows, the stored text bytes before and after ("text_bytes_before",
+        "text_bytes_after") and the database file size before and after ("file_bytes_before", "file_bytes_after").
+    """
+    path = path or config.data_path("llm_cache.sqlite3")
+    conn = sqlite3.connect(path, timeout=30.0)
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    file_bytes_before = os.path.getsize(path)
+    create_tables(conn)
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'chat_completion'").fetchone() is None:
+        conn.close()
+        print("No chat_completion table to migrate in " + path)
+        return None
+
+    text_bytes_before = conn.execute("SELECT COALESCE(SUM(LENGTH(CAST(prompt AS BLOB)) + "
+                                     "LENGTH(CAST(completion AS BLOB))), 0) FROM chat_completion").fetchone()[0]
+    rows_migrated = 0
+    selection = conn.cursor().execute("SELECT model, prompt, completion FROM chat_completion")
+    while True:
+        rows = selection.fetchmany(batch_size)
+        if not rows:
+            break
+        write_entries(conn, [encode_entry(hash_key(row[0] + "\n" + row[1]), row[0], json.loads(row[1]), row[2],
+                                          LEGACY_PARAMETERS) for row in rows])
+        rows_migrated += len(rows)
+    conn.execute("DROP TABLE chat_completion")
+    conn.commit()
+    text_bytes_after = conn.execute("SELECT (SELECT COALESCE(SUM(LENGTH(body)), 0) FROM message_body) + "
+                                    "(SELECT COALESCE(SUM(LENGTH(messages) + LENGTH(completion)), 0) "
+                                    "FROM completion)").fetchone()[0]
+    conn.execute("VACUUM")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+    file_bytes_after = os.path.getsize(path)
+
+    res = {
+        "rows": rows_migrated,
+        "text_bytes_before": text_bytes_before,
+        "text_bytes_after": text_bytes_after,
+        "file_bytes_before": file_bytes_before,
+        "file_bytes_after": file_bytes_after
+    }
+    print(f"Migrated {rows_migrated} rows. Stored text: {text_bytes_before} -> {text_bytes_after} bytes, "
+          f"file: {file_bytes_before} -> {file_bytes_after} bytes "
+          f"({100 * (1 - file_bytes_after / max(file_bytes_before, 1)):.1f}% smaller)")
+    return res
+
+
+if __name__ == "__main__":
+    migrate_chat_completion_table()
@@ -0,0 +1,64 @@
+import os
+
+# Environment variable that overrides the data directory.
+DATA_DIR_VARIABLE = "PROMPT_GPT_DATA_DIR"
+
+# Environment variable that marks the data directory as shared by several hosts, for example over NFS, when set to 1.
+SHARED_VARIABLE = "PROMPT_GPT_SHARED_DATA_DIR"
+
+# The 'data' directory next to 'src', which the scripts used to reach as "..//data//" from inside 'src'.
+DEFAULT_DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+
+data_dir = None
+
+shared = None
+
+
+def get_data_dir():
+    """
+    Returns the data directory: the one set with set_data_dir, else the PROMPT_GPT_DATA_DIR environment variable,
+    else the repository's 'data' directory. It holds the datasets and system messages of the projects, their
+    reports, the completion cache and the sweep and work queue state.
+    """
+    return data_dir or os.environ.get(DATA_DIR_VARIABLE) or DEFAULT_DATA_DIR
+
+
+def set_data_dir(path):
+    """
+    Sets the data directory for the rest of the process. None restores the default.
+    """
+    global data_dir
+    data_dir = path
+
+
+def data_path(*parts):
+    """
+    Returns the path of a file or directory inside the data directory, such as data_path(project, "reports").
+    """
+    return os.path.join(get_data_dir(), *parts)
+
+
+def is_shared():
+    """
+    Returns whether the data directory is shared by several hosts: the value set with set_shared, else whether the
+    PROMPT_GPT_SHARED_DATA_DIR environment variable is set to 1.
+    """
+    return os.environ.get(SHARED_VARIABLE) == "1" if shared is None else shared
+
+
+def set_shared(value):
+    """
+    Marks the data directory as shared by several hosts (True) or local (False) for the rest of the process. None
+    restores the default.
+    """
+    global shared
+    shared = value
+
+
+def get_journal_mode():
+    """
+    Returns the SQLite journal mode of the databases in the data directory. WAL lets readers and a writer work
+    concurrently, but its shared-memory index only works for processes on one host, so a shared data directory uses
+    a rollback journal (DELETE) instead.
+    """
+    return "DELETE" if is_shared() else "WAL"
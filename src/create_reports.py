@@ -1,9 +1,29 @@
 import llm
+import cache as cache_module
+import config
 import sqlite3
 import json
 import metrics
-import numpy as np
+import os
 import random
+import report_store
+import significance
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Sampling parameters of every test call made for a report.
+TEMPERATURE = 0.0
+MAX_TOKENS = 2000
+
+# Instruction that precedes the JSON array of inputs of a packed request.
+PACKING_INSTRUCTION = ("Answer each of the following inputs independently, exactly as you would answer it if it were "
+                       "sent on its own. The inputs are given as a JSON array of strings. Reply with only a JSON array "
+                       "of strings containing your answers, in the same order and with the same number of elements.")
+
+# Datasets loaded by load_dataset, keyed by database path and table name.
+datasets = {}
+datasets_lock = threading.Lock()
 
 
 def check_parameters(parameters, parameters_value):
@@ -38,7 +58,354 @@ def get_dataset(cursor, table_name, parameters):
     return res
 
 
-def create_report(project, model, system_message_file, parameters, k, metric, n=1):
+def load_dataset(project, table_name, parameters, path=None):
+    """
+    Returns the rows of a dataset table whose parameters match the given parameter values, like get_dataset, but
+    reads each table only once per process. The rows are grouped by their 'parameters' value, which is parsed once,
+    and the groups matching a configuration are remembered, so later calls for the same configuration take constant
+    time. Every call returns fresh copies of the rows, which callers may modify and shuffle.
+
+    Parameters:
+    project (str): The name of the project, used to locate <project>/dataset.sqlite3 in the data directory.
+    table_name (str): "train" or "test".
+    parameters (dict): The parameter values to match.
+    path (str, optional): The path of the dataset database, overriding the project location.
+
+    Returns:
+    list of dict: The matching rows, with "id", "name", "input" and "output" keys, in table order.
+    """
+    if path is None:
+        path = config.data_path(project, "dataset.sqlite3")
+    with datasets_lock:
+        dataset = datasets.get((path, table_name))
+        if dataset is None:
+            groups = {}
+            conn = sqlite3.connect(path)
+            selection = conn.execute("SELECT id, name, parameters, input, output FROM " + table_name)
+            for row in selection.fetchall():
+                groups.setdefault(row[2], []).append({
+                    "id": row[0],
+                    "name": row[1],
+                    "input": row[3],
+                    "output": row[4]
+                })
+            conn.close()
+            dataset = {"groups": groups, "matches": {}}
+            datasets[(path, table_name)] = dataset
+
+        configuration = tuple(sorted(parameters.items()))
+        rows = dataset["matches"].get(configuration)
+        if rows is None:
+            rows = []
+            for parameters_value, group in dataset["groups"].items():
+                if check_parameters(parameters, parameters_value):
+                    rows.extend(group)
+            rows.sort(key=lambda x: x["id"])
+            dataset["matches"][configuration] = rows
+    return [dict(row) for row in rows]
+
+
+def select_examples_by_tokens(train, k):
+    """
+    Chooses the training examples that fill a budget of k tokens as completely as possible (a 0/1 knapsack in which
+    the value of an example is its size). The size of an example is the token count of its input and output messages,
+    including the per-message overhead of llm.estimate_tokens. Among equally full selections, examples that come
+    earlier in train are preferred, so the selection only depends on the order of train.
+
+    Returns:
+    list of dict: The chosen examples, in the order of train.
+    """
+    sizes = [llm.estimate_tokens([{"content": example["input"]}, {"content": example["output"]}]) - 3
+             for example in train]
+    mask = (1 << (k + 1)) - 1
+    # reachable[i] has bit c set if some subset of the last len(train) - i examples has a total size of exactly c.
+    reachable = [0] * (len(train) + 1)
+    reachable[len(train)] = 1
+    for i in range(len(train) - 1, -1, -1):
+        reachable[i] = (reachable[i + 1] | (reachable[i + 1] << sizes[i])) & mask
+
+    res = []
+    budget = reachable[0].bit_length() - 1
+    for i in range(len(train)):
+        if budget >= sizes[i] and (reachable[i + 1] >> (budget - sizes[i])) & 1:
+            res.append(train[i])
+            budget -= sizes[i]
+    return res
+
+
+def build_prompt(project, system_message_file, parameters, k, q=0, k_unit="chars"):
+    """
+    Builds the prompt of one repetition of a report: the system message with the parameters substituted, followed by
+    training examples that fit into a budget of k. For q > 0 the training examples are shuffled with seed q before
+    they are chosen.
+
+    With k_unit "chars", k is a number of characters and examples are added greedily in dataset order, skipping those
+    that do not fit. With k_unit "tokens", k is a number of tokens (see llm.count_tokens) and the examples are chosen
+    by select_examples_by_tokens.
+
+    Returns:
+    tuple: The prompt (list of message dictionaries) and the list of test examples.
+    """
+    system_message = ""
+    with open(config.data_path(project, "system", system_message_file + ".txt"), "r", encoding="utf-8") as f:
+        system_message = f.read()
+    for parameter in parameters:
+        system_message = system_message.replace("{" + parameter + "}", parameters[parameter])
+
+    prompt = [{
+        "role": "system",
+        "content": system_message
+    }]
+
+    train = load_dataset(project, "train", parameters)
+    test = load_dataset(project, "test", parameters)
+
+    if q > 0:
+        random.Random(q).shuffle(train)
+
+    if k_unit == "tokens":
+        examples = select_examples_by_tokens(train, k)
+    else:
+        examples = []
+        examples_total_size = 0
+        for example in train:
+            if examples_total_size + len(example["input"]) + len(example["output"]) > k:
+                continue
+            examples.append(example)
+            examples_total_size += len(example["input"]) + len(example["output"])
+
+    for example in examples:
+        prompt.append({
+            "role": "assistant",
+            "content": example["output"]
+        })
+        prompt.append({
+            "role": "user",
+            "content": example["input"]
+        })
+    prompt.reverse()
+    return prompt, test
+
+
+def get_report_name(system_message_file, parameters, model, k, metric, k_unit="chars"):
+    """
+    Returns the file name (without the .json extension) of the report for the given configuration. Token budgets are
+    marked with " k_unit=tokens"; character budgets keep the original names.
+    """
+    report_name = "system=" + system_message_file
+    parameters_keys = list(parameters.keys())
+    parameters_keys.sort()
+    for parameter in parameters_keys:
+        report_name += " " + parameter + "=" + parameters[parameter] + " "
+    report_name += " model=" + model + " k=" + str(k) + " metric=" + metric
+    if k_unit != "chars":
+        report_name += " k_unit=" + k_unit
+    return report_name
+
+
+def save_report(path, report):
+    """
+    Writes a report to a JSON file atomically: the report is written to a temporary file next to the target, which
+    then replaces the target, so readers never see a partially written report.
+    """
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=4, ensure_ascii=False)
+    os.replace(temporary_path, path)
+
+
+def pack_inputs(inputs):
+    """
+    Builds the content of a user message that asks for several test inputs to be answered in one request: the
+    PACKING_INSTRUCTION followed by the inputs as a JSON array of strings.
+    """
+    return PACKING_INSTRUCTION + "\n\n" + json.dumps(inputs, indent=4, ensure_ascii=False)
+
+
+def unpack_outputs(llm_output, n):
+    """
+    Parses the answer to a packed request (see pack_inputs) into a list of n outputs. A surrounding Markdown code
+    fence is ignored. Items that are not strings are None, and so is every item if the answer is not a JSON array of
+    n elements.
+    """
+    text = llm_output.strip()
+    if text.startswith("```"):
+        text = text.split("\n", 1)[-1].rsplit("```", 1)[0]
+    try:
+        outputs = json.loads(text)
+    except ValueError:
+        return [None] * n
+    if not isinstance(outputs, list) or len(outputs) != n:
+        return [None] * n
+    return [output if isinstance(output, str) else None for output in outputs]
+
+
+def evaluate_tests(cache, prompt, test, model, metric, max_workers=1, pack_size=1, telemetry=None):
+    """
+    Runs the language model on every test example and scores its output. Each example is appended as the last user
+    message of the prompt, the model output is stored in example["llm_output"] and the score in example["score"].
+    The estimated number of prompt tokens sent for the example is stored in example["prompt_tokens"].
+
+    With max_workers > 1 the calls are fanned out to a thread pool that keeps at most max_workers requests in flight.
+    Examples are scored as soon as their result arrives, and the results are written back into the test list in
+    place, so the order of the test list is preserved. The cache is used exactly as in the sequential mode.
+
+    With pack_size > 1, up to pack_size examples are sent in one request (see pack_inputs), so the system message
+    and the few-shot examples are sent once per pack instead of once per example. Examples whose answer cannot be
+    parsed from the packed reply are sent again on their own. Packed requests have different messages, so they are
+    cached separately from single ones. The prompt tokens of a packed request are split evenly between its examples.
+
+    Parameters:
+    cache (cache.ChatCompletionCache): The chat completion cache passed on to llm.call_llm.
+    prompt (list of dict): The prompt (system message and examples) shared by all test calls.
+    test (list of dict): The test examples, each with "input" and "output" keys.
+    model (str): The name of the model to be evaluated.
+    metric (str): The name of the metric to be used for evaluation.
+    max_workers (int, optional): The maximum number of concurrent requests. Defaults to 1 (sequential).
+    pack_size (int, optional): The maximum number of examples per request. Defaults to 1 (no packing).
+    telemetry (list, optional): If given, the telemetry record of every llm.call_llm call is appended to it.
+        Defaults to None.
+
+    Returns:
+    list of dict: The test list with "llm_output", "score" and "prompt_tokens" filled in.
+
+    Raises:
+    ValueError: If pack_size is less than 1.
+    """
+    if pack_size < 1:
+        raise ValueError("pack_size must be at least 1, got " + str(pack_size))
+
+    def call(content):
+        messages = prompt + [{
+            "role": "user",
+            "content": content
+        }]
+        llm_result = llm.call_llm(cache, messages, model=model, temperature=TEMPERATURE, max_tokens=MAX_TOKENS,
+                                  streaming=True, telemetry=telemetry)
+        return llm_result, llm.estimate_tokens(messages)
+
+    def run(examples):
+        if len(examples) == 1:
+            return [call(examples[0]["input"])]
+        llm_result, prompt_tokens = call(pack_inputs([example["input"] for example in examples]))
+        res = []
+        for example, output in zip(examples, unpack_outputs(llm_result, len(examples))):
+            if output is None:
+                output, single_prompt_tokens = call(example["input"])
+                res.append((output, prompt_tokens / len(examples) + single_prompt_tokens))
+            else:
+                res.append((output, prompt_tokens / len(examples)))
+        return res
+
+    def score(examples, results):
+        for example, (llm_result, prompt_tokens) in zip(examples, results):
+            example["llm_output"] = llm_result
+            example["score"] = metrics.calculate_metric(example["output"], example["llm_output"], metric)
+            example["prompt_tokens"] = prompt_tokens
+
+    packs = [test[i:i + pack_size] for i in range(0, len(test), pack_size)]
+    if max_workers <= 1:
+        for examples in packs:
+            score(examples, run(examples))
+        return test
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(run, examples): examples for examples in packs}
+        try:
+            for future in as_completed(futures):
+                score(futures[future], future.result())
+        except BaseException:
+            # Cancel the queued calls so that a failed call or Ctrl-C surfaces after the calls in flight instead of
+            # after every call of the report.
+            executor.shutdown(cancel_futures=True)
+            raise
+    return test
+
+
+def plan_report(project, model, system_message_file, parameters, k, n=1, max_workers=1, cache=None, seen=None,
+                k_unit="chars"):
+    """
+    Builds every prompt of a report without calling the API and reports what running it would cost. Calls that are
+    found in the cache, or that already appear earlier in the plan, are counted as cache hits.
+
+    Parameters:
+    project, model, system_message_file, parameters, k, n, max_workers, k_unit: As in create_report.
+    cache (cache.ChatCompletionCache, optional): The completion cache to check. Opened if None.
+    seen (set, optional): The cache keys of calls planned so far; updated in place. Used by plan_sweep to count
+        calls shared between configurations only once.
+
+    Returns:
+    dict: The number of "calls", cache "hits" and "misses", the estimated "prompt_tokens" and "completion_tokens" of
+    the misses, the projected "cost" in USD and the projected "runtime" in seconds.
+    """
+    own_cache = cache is None
+    if own_cache:
+        cache = llm.get_chat_completion_cache()
+    if seen is None:
+        seen = set()
+    call_parameters = {"temperature": TEMPERATURE, "max_tokens": MAX_TOKENS}
+
+    plan = {"calls": 0, "hits": 0, "misses": 0, "prompt_tokens": 0, "completion_tokens": 0}
+    for q in range(n):
+        prompt, test = build_prompt(project, system_message_file, parameters, k, q, k_unit)
+        for example in test:
+            messages = prompt + [{
+                "role": "user",
+                "content": example["input"]
+            }]
+            key = cache_module.make_key(model, messages, call_parameters)
+            plan["calls"] += 1
+            if key in seen or cache.get(model, messages, call_parameters) is not None:
+                plan["hits"] += 1
+                continue
+            seen.add(key)
+            plan["misses"] += 1
+            plan["prompt_tokens"] += llm.estimate_tokens(messages)
+            plan["completion_tokens"] += llm.estimate_tokens([{"content": example["output"]}])
+
+    if own_cache:
+        cache.close()
+    plan["cost"] = llm.estimate_cost(model, plan["prompt_tokens"], plan["completion_tokens"])
+    plan["runtime"] = llm.estimate_runtime(model, plan["misses"], plan["prompt_tokens"] + plan["misses"] * MAX_TOKENS,
+                                           max_workers)
+    return plan
+
+
+def plan_sweep(configurations, max_workers=1):
+    """
+    Plans a list of reports without calling the API and prints the cache hits, cache misses, estimated tokens,
+    projected cost and projected runtime per model. Calls shared between configurations are counted once.
+
+    Parameters:
+    configurations (list of dict): The keyword arguments of each create_report call.
+    max_workers (int, optional): The number of concurrent calls assumed for the runtime estimate. Defaults to 1.
+
+    Returns:
+    dict: For every model, the totals of the plans returned by plan_report.
+    """
+    cache = llm.get_chat_completion_cache()
+    seen = set()
+    res = {}
+    for configuration in configurations:
+        plan = plan_report(configuration["project"], configuration["model"], configuration["system_message_file"],
+                           configuration["parameters"], configuration["k"], configuration.get("n", 1),
+                           max_workers=max_workers, cache=cache, seen=seen,
+                           k_unit=configuration.get("k_unit", "chars"))
+        totals = res.setdefault(configuration["model"], dict.fromkeys(plan, 0))
+        for key in plan:
+            totals[key] += plan[key]
+    cache.close()
+
+    for model in res:
+        totals = res[model]
+        print(f"{model}: {totals['calls']} calls, {totals['hits']} cache hits, {totals['misses']} cache misses, "
+              f"~{totals['prompt_tokens']} prompt tokens, ~{totals['completion_tokens']} completion tokens, "
+              f"~${totals['cost']:.2f}, ~{totals['runtime'] / 60:.1f} min")
+    return res
+
+
+def create_report(project, model, system_message_file, parameters, k, metric, n=1, max_workers=1, plan=False,
+                  cache=None, pack_size=1, k_unit="chars"):
     """
     This function generates a report for a given project using provided parameters and evaluates it with a given
     metric. It first reads a system message from a file, substitutes parameters in this message, and then
@@ -46,6 +413,12 @@ def create_report(project, model, system_message_file, parameters, k, metric, n=
     language model and uses testing data to evaluate the model's performance. Finally, it saves the best report
     to a JSON file.
 
+    Only the best repetition so far is kept in full; of the others, only the summary statistics are kept, so memory
+    use does not grow with n. The report is written once, at the end, with save_report. It records the average of
+    every repetition in "history", their average, median and std in "repetitions", and the index of the best one in
+    "best_repetition". The best one also gets a bootstrap confidence interval of its average and the number of tests
+    needed for a narrower one (see significance.summarize_confidence).
+
     Parameters:
     -----------
     project : str
@@ -63,7 +436,7 @@ def create_report(project, model, system_message_file, parameters, k, metric, n=
         A dictionary of parameter names and values to be substituted into the system message.
 
     k : int
-        The maximum size (in number of characters) of the chat history examples
+        The maximum size (in number of characters, or of tokens if k_unit is "tokens") of the chat history examples
         to be used in the prompt for the language model.
 
     metric : str
@@ -72,141 +445,143 @@ def create_report(project, model, system_message_file, parameters, k, metric, n=
     n : int, optional
         The number of times to repeat the whole process (default is 1).
 
+    max_workers : int, optional
+        The maximum number of test examples sent to the language model concurrently (default is 1, sequential).
+
+    plan : bool, optional
+        If True, nothing is evaluated: the prompts are built, checked against the cache and the plan returned by
+        plan_report is returned (default is False).
+
+    cache : cache.ChatCompletionCache, optional
+        The completion cache to use. If None, the cache is opened for this report and closed at the end.
+
+    pack_size : int, optional
+        The maximum number of test examples sent in one request (default is 1, one request per example). See
+        evaluate_tests. The report records the average estimated prompt tokens sent per example.
+
+    k_unit : str, optional
+        "chars" (default) or "tokens": the unit of k. See build_prompt. The report records the estimated number of
+        tokens of the prompt in "prompt_tokens".
+
     Returns:
     --------
-    None. The function saves the generated report in a JSON file in the 'reports' subdirectory under the project
-    directory. The name of the report file is determined by the system message file name, the parameters, the
-    model name, the value of k, and the metric name.
+    None. The function saves the generated report in the project's report store (see report_store.ReportStore) and
+    in a JSON file in the 'reports' subdirectory under the project directory. The name of the report file, which is
+    also its name in the store, is determined by the system message file name, the parameters, the model name, the
+    value of k, and the metric name.
 
     Raises:
     -------
     FileNotFoundError: If the system message file or the SQLite database file does not exist.
     sqlite3.OperationalError: If there is a problem with the SQLite database operations.
+    ValueError: If pack_size is less than 1.
     """
 
-    cache = llm.get_chat_completion_cache()
-
-    history = []
-    reports = []
+    if pack_size < 1:
+        raise ValueError("pack_size must be at least 1, got " + str(pack_size))
 
-    for q in range(n):
-        system_message = ""
-        with open("..//data//" + project + "//system//" + system_message_file + ".txt", "r", encoding="utf-8") as f:
-            system_message = f.read()
-        for parameter in parameters:
-            system_message = system_message.replace("{" + parameter + "}", parameters[parameter])
-
-        prompt = [{
-            "role": "system",
-            "content": system_message
-        }]
+    if plan:
+        return plan_report(project, model, system_message_file, parameters, k, n, max_workers=max_workers,
+                           cache=cache, k_unit=k_unit)
 
-        conn = sqlite3.connect("..//data//" + project + "//dataset.sqlite3")
-        cursor = conn.cursor()
-        train = get_dataset(cursor, "train", parameters)
-        test = get_dataset(cursor, "test", parameters)
-        conn.commit()
-        conn.close()
+    own_cache = cache is None
+    if own_cache:
+        cache = llm.get_chat_completion_cache()
 
-        if q > 0:
-            random.seed(q)
-            random.shuffle(train)
+    report_name = get_report_name(system_message_file, parameters, model, k, metric, k_unit)
+    repetitions = []
+    best = None
 
-        examples_total_size = 0
-        for example in train:
-            if examples_total_size + len(example["input"]) + len(example["output"]) > k:
-                continue
-            prompt.append({
-                "role": "assistant",
-                "content": example["output"]
-            })
-            prompt.append({
-                "role": "user",
-                "content": example["input"]
-            })
-            examples_total_size += len(example["input"]) + len(example["output"])
-        prompt.reverse()
-
-        report_name = "system=" + system_message_file
-        parameters_keys = list(parameters.keys())
-        parameters_keys.sort()
-        for parameter in parameters_keys:
-            report_name += " " + parameter + "=" + parameters[parameter] + " "
-        report_name += " model=" + model + " k=" + str(k) + " metric=" + metric
+    for q in range(n):
+        prompt, test = build_prompt(project, system_message_file, parameters, k, q, k_unit)
 
         report = {
             "system_message_file": system_message_file,
             "model": model,
             "parameters": parameters,
             "k": k,
+            "k_unit": k_unit,
             "metric": metric,
-            "history": history,
         }
 
-        for example in test:
-            prompt.append(
-                {
-                    "role": "user",
-                    "content": example["input"]
-                }
-            )
-            llm_result = llm.call_llm(cache, prompt, model=model, temperature=0.0, max_tokens=2000,
-                                      streaming=True)
-            example["llm_output"] = llm_result
-            example["score"] = metrics.calculate_metric(example["output"], example["llm_output"], metric)
-            prompt.pop()
+        telemetry = []
+        start = time.perf_counter()
+        evaluate_tests(cache, prompt, test, model, metric, max_workers=max_workers, pack_size=pack_size,
+                       telemetry=telemetry)
+        wall_time = time.perf_counter() - start
 
         test.sort(key=lambda x: x["score"], reverse=True)
         metric_values = [example["score"] for example in test]
 
-        average = np.average(metric_values)
-        std = np.std(metric_values)
-        median = np.median(metric_values)
-        percentiles_ = np.percentile(metric_values, [10, 20, 25, 30, 40, 50, 60, 70, 75, 80, 90])
-        percentiles = {
-            "10": percentiles_[0],
-            "20": percentiles_[1],
-            "25": percentiles_[2],
-            "30": percentiles_[3],
-            "40": percentiles_[4],
-            "50": percentiles_[5],
-            "60": percentiles_[6],
-            "70": percentiles_[7],
-            "75": percentiles_[8],
-            "80": percentiles_[9],
-            "90": percentiles_[10]
-        }
-        report["average"] = average
-        report["median"] = median
-        report["std"] = std
-        report["percentiles"] = percentiles
+        report.update(metrics.summarize_scores(metric_values))
+        repetitions.append({"average": report["average"], "median": report["median"], "std": report["std"]})
+        if best is not None and report["average"] <= best["average"]:
+            continue
+
         report["n_tests"] = len(test)
-        report["history"].append(average)
+        report["pack_size"] = pack_size
+        report["prompt_tokens_per_example"] = sum(example["prompt_tokens"] for example in test) / len(test)
+        report["best_repetition"] = q
+        report.update(significance.summarize_confidence(metric_values))
         report["prompt"] = prompt
+        report["prompt_tokens"] = llm.estimate_tokens(prompt)
+        report["telemetry"] = llm.summarize_telemetry(telemetry, wall_time)
         report["tests"] = test
+        best = report
 
-        reports.append(report)
-        reports.sort(key=lambda x: x["average"], reverse=True)
-
-        json.dump(reports[0],
-                  open("..//data//" + project + "//reports//" + report_name + ".json", "w", encoding="utf-8"),
-                  indent=4,
-                  ensure_ascii=False)
-
+    best["history"] = [repetition["average"] for repetition in repetitions]
+    best["repetitions"] = repetitions
+    save_report(config.data_path(project, "reports", report_name + ".json"), best)
 
-if __name__ == "__main__":
-    for i in range(1, 7):
-        create_report("grammar_correction", "gpt-3.5-turbo", str(i), {"language": "English"}, 2000, "bleu", 10)
-        create_report("grammar_correction", "gpt-3.5-turbo", str(i), {"language": "English"}, 0, "bleu", 10)
+    store = report_store.ReportStore(project)
+    store.save(report_name, best)
+    store.close()
 
-    create_report("grammar_correction", "gpt-3.5-turbo", "4", {"language": "English"}, 500, "bleu", 10)
-    create_report("grammar_correction", "gpt-3.5-turbo", "4", {"language": "English"}, 1000, "bleu", 10)
-    create_report("grammar_correction", "gpt-3.5-turbo", "4", {"language": "English"}, 2000, "bleu", 10)
+    if own_cache:
+        cache.close()
 
-    create_report("grammar_correction", "gpt-4", "4", {"language": "English"}, 0, "bleu", 10)
 
-    create_report("grammar_correction", "gpt-3.5-turbo", "4", {"language": "Russian"}, 0, "bleu", 10)
-    create_report("grammar_correction", "gpt-3.5-turbo", "4", {"language": "Spanish"}, 0, "bleu", 10)
-    create_report("grammar_correction", "gpt-3.5-turbo", "4", {"language": "French"}, 0, "bleu", 10)
-    create_report("grammar_correction", "gpt-3.5-turbo", "4", {"language": "German"}, 0, "bleu", 10)
-    create_report("grammar_correction", "gpt-3.5-turbo", "4", {"language": "Dutch"}, 0, "bleu", 10)
+if __name__ == "__main__":
+    import logging
+    import sweep
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    sweep.run_sweep([
+        {
+            "project": "grammar_correction",
+            "system_message_files": ["1", "2", "3", "4", "5", "6"],
+            "models": ["gpt-3.5-turbo"],
+            "parameters": [{"language": "English"}],
+            "ks": [2000, 0],
+            "metric": "bleu",
+            "n": 10
+        },
+        {
+            "project": "grammar_correction",
+            "system_message_files": ["4"],
+            "models": ["gpt-3.5-turbo"],
+            "parameters": [{"language": "English"}],
+            "ks": [500, 1000, 2000],
+            "metric": "bleu",
+            "n": 10
+        },
+        {
+            "project": "grammar_correction",
+            "system_message_files": ["4"],
+            "models": ["gpt-4"],
+            "parameters": [{"language": "English"}],
+            "ks": [0],
+            "metric": "bleu",
+            "n": 10
+        },
+        {
+            "project": "grammar_correction",
+            "system_message_files": ["4"],
+            "models": ["gpt-3.5-turbo"],
+            "parameters": [{"language": language} for language in ["Russian", "Spanish", "French", "German", "Dutch"]],
+            "ks": [0],
+            "metric": "bleu",
+            "n": 10
+        }
+    ])
@@ -1,117 +1,710 @@
-import openai
+import json
+import logging
 import os
+import random
 import time
-import sqlite3
-import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import cache as cache_module
+
+logger = logging.getLogger(__name__)
+
+# Requests per minute and tokens per minute allowed for each model. Models that are not listed are not limited.
+RATE_LIMITS = {
+    "gpt-3.5-turbo": {"rpm": 3500, "tpm": 90000},
+    "gpt-4": {"rpm": 200, "tpm": 40000},
+}
+
+# Fraction of the quota the limiter aims for, so that bursts stay just under the provider limit.
+RATE_LIMIT_HEADROOM = 0.95
+
+# Capacity of the rate limiter's buckets in seconds of quota: after a quiet period, at most this much of the quota
+# (and at least one request) is let out at once, and the rest is paced at the per-minute rate.
+RATE_LIMIT_BURST_SECONDS = 2.0
+
+# Price in USD per 1000 prompt tokens and per 1000 completion tokens, used for cost estimates.
+MODEL_PRICES = {
+    "gpt-3.5-turbo": (0.0015, 0.002),
+    "gpt-4": (0.03, 0.06),
+}
+
+# Typical duration of one uncached call in seconds, used for runtime estimates.
+MODEL_LATENCY = {
+    "gpt-3.5-turbo": 3.0,
+    "gpt-4": 10.0,
+}
+
+
+def approximate_token_count(text):
+    """
+    Approximates the number of tokens in a text without a tokenizer: about 4 characters per token for ASCII text, one
+    token per CJK character and 2 characters per token for other scripts.
+    """
+    ascii_characters = 0
+    cjk_characters = 0
+    for character in text:
+        if character < "\x80":
+            ascii_characters += 1
+        elif "\u2e80" <= character <= "\u9fff" or "\uac00" <= character <= "\ud7af" or \
+                "\uf900" <= character <= "\ufaff":
+            cjk_characters += 1
+    other_characters = len(text) - ascii_characters - cjk_characters
+    return (ascii_characters + 3) // 4 + cjk_characters + (other_characters + 1) // 2
+
+
+def get_tiktoken_counter(model="gpt-3.5-turbo"):
+    """
+    Returns a function that counts the tokens of a text exactly with the tokenizer of the given model. Requires the
+    optional tiktoken package.
+
+    Raises:
+    ImportError: If tiktoken is not installed.
+    """
+    import tiktoken
+
+    encoding = tiktoken.encoding_for_model(model)
+    return lambda text: len(encoding.encode(text))
+
+
+# The function used to count the tokens of a text. Replace it with set_token_counter.
+token_counter = approximate_token_count
+
+
+def set_token_counter(counter):
+    """
+    Sets the function used by count_tokens and estimate_tokens, for example get_tiktoken_counter("gpt-4").
+    Passing None restores approximate_token_count.
+    """
+    global token_counter
+    token_counter = approximate_token_count if counter is None else counter
+
+
+def count_tokens(text):
+    """
+    Counts the tokens of a text with the current token counter.
+    """
+    return token_counter(text)
+
+
+def estimate_tokens(messages):
+    """
+    Estimates the number of prompt tokens in a list of messages with the current token counter, plus a few tokens of
+    per-message overhead.
+    """
+    return sum(count_tokens(message["content"]) + 4 for message in messages) + 3
+
+
+def estimate_cost(model, prompt_tokens, completion_tokens):
+    """
+    Estimates the price in USD of sending prompt_tokens and receiving completion_tokens, according to MODEL_PRICES.
+    Returns 0.0 for models without a known price.
+    """
+    prices = MODEL_PRICES.get(model, (0.0, 0.0))
+    return prompt_tokens / 1000 * prices[0] + completion_tokens / 1000 * prices[1]
+
+
+def estimate_runtime(model, calls, reserved_tokens, max_workers=1):
+    """
+    Estimates the wall-clock time in seconds of making a number of uncached calls to a model with max_workers calls
+    in flight. The estimate is the larger of the latency bound (MODEL_LATENCY) and the time the rate limiter needs to
+    let the calls and their reserved tokens (prompt tokens plus max_tokens per call) through.
+    """
+    res = calls * MODEL_LATENCY.get(model, 5.0) / max_workers
+    if model in RATE_LIMITS:
+        limit = RATE_LIMITS[model]
+        res = max(res,
+                  calls * 60 / (limit["rpm"] * RATE_LIMIT_HEADROOM),
+                  reserved_tokens * 60 / (limit["tpm"] * RATE_LIMIT_HEADROOM))
+    return res
+
+
+class RateLimiter:
+    """
+    Client-side rate limiter shared by all LLM calls. For every model it keeps two token buckets, one for requests and
+    one for tokens, each refilled continuously at the configured per-minute rate and holding at most burst_seconds of
+    quota. acquire() blocks until both buckets hold enough capacity, which paces the calls evenly just under the quota
+    instead of bursting and getting throttled.
+    """
+
+    def __init__(self, limits=None, headroom=RATE_LIMIT_HEADROOM, burst_seconds=RATE_LIMIT_BURST_SECONDS):
+        self.limits = dict(RATE_LIMITS if limits is None else limits)
+        self.headroom = headroom
+        self.burst_seconds = burst_seconds
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.usage = {}
+
+    def set_limit(self, model, rpm, tpm):
+        """
+        Sets the requests-per-minute and tokens-per-minute limits of a model. Existing buckets are reset.
+        """
+        with self.lock:
+            self.limits[model] = {"rpm": rpm, "tpm": tpm}
+            self.buckets.pop(model, None)
+
+    def _capacity(self, model):
+        limit = self.limits[model]
+        return (max(1.0, limit["rpm"] * self.headroom * self.burst_seconds / 60),
+                limit["tpm"] * self.headroom * self.burst_seconds / 60)
+
+    def _bucket(self, model, now):
+        limit = self.limits[model]
+        request_capacity, token_capacity = self._capacity(model)
+        if model not in self.buckets:
+            self.buckets[model] = {
+                "requests": request_capacity,
+                "tokens": token_capacity,
+                "updated": now
+            }
+            self.usage[model] = []
+        bucket = self.buckets[model]
+        elapsed = now - bucket["updated"]
+        bucket["requests"] = min(request_capacity, bucket["requests"] + elapsed * limit["rpm"] * self.headroom / 60)
+        bucket["tokens"] = min(token_capacity, bucket["tokens"] + elapsed * limit["tpm"] * self.headroom / 60)
+        bucket["updated"] = now
+        return bucket
+
+    def _recent_usage(self, model, now):
+        usage = [entry for entry in self.usage.get(model, []) if now - entry[0] < 60]
+        self.usage[model] = usage
+        return usage
+
+    def acquire(self, model, tokens):
+        """
+        Blocks until one request with the given estimated number of tokens can be sent to the model without exceeding
+        its limits. Calls for models without configured limits return immediately.
+        """
+        if model not in self.limits:
+            return
+        while True:
+            with self.lock:
+                limit = self.limits[model]
+                now = time.monotonic()
+                bucket = self._bucket(model, now)
+                usage = self._recent_usage(model, now)
+                tokens_needed = min(tokens, limit["tpm"] * self.headroom)
+                # A request larger than the whole bucket is let through once the bucket is full; the bucket then goes
+                # negative, which holds the following requests back until its tokens are paid off.
+                tokens_available = min(tokens_needed, self._capacity(model)[1])
+                window_full = usage and (len(usage) + 1 > limit["rpm"] * self.headroom or
+                                         sum(entry[1] for entry in usage) + tokens_needed >
+                                         limit["tpm"] * self.headroom)
+                if bucket["requests"] >= 1 and bucket["tokens"] >= tokens_available and not window_full:
+                    bucket["requests"] -= 1
+                    bucket["tokens"] -= tokens_needed
+                    usage.append((now, tokens_needed))
+                    return
+                wait = max((1 - bucket["requests"]) * 60 / (limit["rpm"] * self.headroom),
+                           (tokens_available - bucket["tokens"]) * 60 / (limit["tpm"] * self.headroom))
+                if window_full:
+                    wait = max(wait, usage[0][0] + 60 - now)
+            time.sleep(max(wait, 0.001))
+
+    def utilization(self, model):
+        """
+        Returns how close the model is to its quota over the last minute, as a dictionary with the number of requests
+        and tokens sent and their fractions of the configured limits ("rpm_utilization", "tpm_utilization").
+        """
+        with self.lock:
+            if model not in self.limits:
+                return None
+            limit = self.limits[model]
+            usage = self._recent_usage(model, time.monotonic())
+            requests = len(usage)
+            tokens = sum(entry[1] for entry in usage)
+            return {
+                "requests": requests,
+                "tokens": tokens,
+                "rpm_utilization": requests / limit["rpm"],
+                "tpm_utilization": tokens / limit["tpm"]
+            }
+
+
+rate_limiter = RateLimiter()
+
+
+# Timeout in seconds of a single API request.
+REQUEST_TIMEOUT = 60
+
+# Retry policy of call_llm: at most max_attempts attempts, with exponential backoff and full jitter between them
+# (a random delay of up to base_delay * 2 ** attempt seconds, capped at max_delay).
+RETRY_POLICY = {
+    "max_attempts": 8,
+    "base_delay": 1.0,
+    "max_delay": 60.0,
+}
+
+# A model's circuit opens after this many consecutive failed attempts and stays open for this many seconds.
+CIRCUIT_BREAKER_THRESHOLD = 5
+CIRCUIT_BREAKER_COOLDOWN = 30.0
+
+
+def classify_error(error):
+    """
+    Classifies an exception raised by an API call as "rate_limit", "transient" or "fatal". Rate limit and transient
+    errors are retried; fatal errors (invalid requests, unknown models, authentication problems, exhausted quota) are
+    raised immediately. Besides OpenAI errors, only OSError (which includes network errors and TimeoutError) is
+    transient: any other exception, such as a KeyError or TypeError in a backend, is a bug and fatal.
+    """
+    import openai
+
+    if isinstance(error, openai.error.RateLimitError):
+        if getattr(error, "code", None) == "insufficient_quota":
+            return "fatal"
+        return "rate_limit"
+    if isinstance(error, (openai.error.Timeout, openai.error.APIConnectionError, openai.error.ServiceUnavailableError,
+                          openai.error.TryAgain)):
+        return "transient"
+    if isinstance(error, (openai.error.InvalidRequestError, openai.error.AuthenticationError,
+                          openai.error.PermissionError, openai.error.InvalidAPIType)):
+        return "fatal"
+    if isinstance(error, openai.error.OpenAIError):
+        status = error.http_status
+        if status == 429:
+            return "rate_limit"
+        if status is None or status >= 500 or status in (408, 409):
+            return "transient"
+        return "fatal"
+    if isinstance(error, OSError):
+        return "transient"
+    return "fatal"
+
+
+def get_retry_after(error):
+    """
+    Returns the delay in seconds requested by the server through a Retry-After (or retry-after-ms) header of the
+    error's response, or None if there is none.
+    """
+    headers = getattr(error, "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms") is not None:
+            return float(headers.get("retry-after-ms")) / 1000
+        if headers.get("retry-after") is not None:
+            return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+def get_backoff_delay(attempt, error=None):
+    """
+    Returns how long to wait before retrying after the given failed attempt (counted from 0): exponential backoff with
+    full jitter according to RETRY_POLICY, but at least the server's Retry-After hint for rate limit errors.
+    """
+    delay = random.uniform(0, min(RETRY_POLICY["max_delay"], RETRY_POLICY["base_delay"] * 2 ** attempt))
+    if error is not None and classify_error(error) == "rate_limit":
+        retry_after = get_retry_after(error)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+    return delay
+
+
+class CircuitBreaker:
+    """
+    Per-model circuit breaker. After CIRCUIT_BREAKER_THRESHOLD consecutive failed attempts the circuit opens and
+    callers wait in before_call() instead of sending requests. After CIRCUIT_BREAKER_COOLDOWN seconds a single probe
+    request is let through; its success closes the circuit and its failure opens it again.
+    """
+
+    def __init__(self, threshold=CIRCUIT_BREAKER_THRESHOLD, cooldown=CIRCUIT_BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.condition = threading.Condition()
+
+    def before_call(self):
+        """
+        Blocks while the circuit is open or while another caller's probe request is in flight.
+        """
+        with self.condition:
+            while self.opened_at is not None:
+                remaining = self.opened_at + self.cooldown - time.monotonic()
+                if remaining <= 0 and not self.probing:
+                    self.probing = True
+                    return
+                self.condition.wait(remaining if remaining > 0 else None)
+
+    def record_success(self):
+        with self.condition:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+            self.condition.notify_all()
+
+    def record_failure(self):
+        with self.condition:
+            self.failures += 1
+            if self.probing or self.failures >= self.threshold:
+                if self.opened_at is None or self.probing:
+                    logger.warning("Circuit opened after %d consecutive failures", self.failures)
+                self.opened_at = time.monotonic()
+            self.probing = False
+            self.condition.notify_all()
 
 
-def get_chat_completion_cache():
+circuit_breakers = {}
+circuit_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(model):
+    """
+    Returns the circuit breaker of a model, creating it on first use.
     """
-    Fetches chat completion data from a SQLite3 database and returns it in dictionary format. The function reads from
-    the 'chat_completion' table in the database and maps each combination of model and prompt to its respective
-    completion.
+    with circuit_breakers_lock:
+        if model not in circuit_breakers:
+            circuit_breakers[model] = CircuitBreaker()
+        return circuit_breakers[model]
+
+
+def get_chat_completion_cache(path=None):
+    """
+    Opens the chat completion cache stored in a SQLite3 database. Completions are looked up lazily, one row at a time,
+    through an index on the hashed cache key; see cache.ChatCompletionCache.
 
     Returns:
-    dict: A dictionary containing cached chat completions. The keys are strings formed by concatenating the model
-        name and the prompt with a newline character ("\n") in between. The values are the corresponding completions
-        from the database.
+    cache.ChatCompletionCache: The cache object, with get(model, messages, parameters) and
+    put(model, messages, completion, parameters).
 
     Note:
-    This function assumes that there is a SQLite3 database at the path "..//data//llm_cache.sqlite3", and that this
-    database contains a table named 'chat_completion' with columns 'model', 'prompt', and 'completion'.
-    """
-    res = {}
-    conn = sqlite3.connect("..//data//llm_cache.sqlite3")
-    cursor = conn.cursor()
-    selection = cursor.execute("SELECT model, prompt, completion output FROM chat_completion")
-    selection = selection.fetchall()
-    for row in selection:
-        res[row[0] + "\n" + row[1]] = row[2]
-    conn.commit()
-    conn.close()
-    return res
+    The SQLite3 database is llm_cache.sqlite3 in the data directory (see config.get_data_dir) unless another path is
+    given. The 'completion', 'message_body' and 'telemetry' tables are created if they do not exist.
+    """
+    return cache_module.ChatCompletionCache(path)
 
 
-def call_chatgpt_on_messages(messages, model="gpt-3.5-turbo", temperature=0.0, max_tokens=100, streaming=False):
+def call_chatgpt_on_messages(messages, model="gpt-3.5-turbo", temperature=0.0, max_tokens=100, streaming=False,
+                             request_timeout=REQUEST_TIMEOUT, timing=None):
     """
-    Calls the ChatGPT API with the given messages, model, temperature, max tokens, and streaming option.
-    Prints the role and content of the messages and returns the response from the API.
+    Calls the ChatGPT API with the given messages, model, temperature, max tokens, and streaming option. The openai
+    package is imported on first use.
+    Logs the role and content of the messages at DEBUG level and returns the response from the API. The request is
+    aborted after request_timeout seconds.
+
+    If a timing dictionary is given, the time to the first streamed token ("ttft") and the total "latency" of the
+    call are stored in it, in seconds. Without streaming, the time to first token is the total latency.
     """
-    print("Calling chatgpt with model " + model + " and temperature " + str(temperature) + "...")
-    for message in messages:
-        print(message["role"] + ": " + message["content"])
-    print("--------")
+    import openai
 
+    logger.debug("Calling chatgpt with model %s and temperature %s...", model, temperature)
+    if logger.isEnabledFor(logging.DEBUG):
+        for message in messages:
+            logger.debug("%s: %s", message["role"], message["content"])
+    start = time.perf_counter()
     completion = openai.ChatCompletion.create(
         model=model,
         messages=messages,
         temperature=temperature,
         max_tokens=max_tokens,
         stream=streaming,
-        request_timeout=15
+        request_timeout=request_timeout
     )
 
     if streaming:
-        res = ""
+        chunks = []
         for stuff in completion:
             if "content" in stuff["choices"][0]["delta"]:
-                res += stuff["choices"][0]["delta"]["content"]
-                print("Streamed", stuff["choices"][0]["delta"]["content"])
-        print(res)
+                if not chunks and timing is not None:
+                    timing["ttft"] = time.perf_counter() - start
+                chunks.append(stuff["choices"][0]["delta"]["content"])
+        res = "".join(chunks)
+    else:
+        res = completion["choices"][0]["message"]["content"]
+
+    if timing is not None:
+        timing["latency"] = time.perf_counter() - start
+        timing.setdefault("ttft", timing["latency"])
+    logger.debug("Completion: %s", res)
+    return res
+
+
+class OpenAIBackend:
+    """
+    Model backend that sends chat completion requests to the OpenAI API with call_chatgpt_on_messages.
+
+    A model backend is any object with a complete(messages, model, temperature, max_tokens, streaming,
+    request_timeout, timing) method that returns the completion text, fills the timing dictionary like
+    call_chatgpt_on_messages and raises openai.error exceptions (see classify_error) on failure. call_llm sends
+    each request to the backend registered for its model with set_backend, or to default_backend.
+    """
+
+    def complete(self, messages, model, temperature, max_tokens, streaming, request_timeout, timing):
+        import openai
+
+        openai.api_key = os.environ.get("OPENAI_API_KEY")
+        return call_chatgpt_on_messages(messages, model=model, temperature=temperature, max_tokens=max_tokens,
+                                        streaming=streaming, request_timeout=request_timeout, timing=timing)
+
+
+class MockBackend:
+    """
+    Deterministic local model backend for tests and offline benchmarks. It answers with the content of the last
+    message, or with respond(messages) if given, after latency seconds; when streaming, the answer is produced word
+    by word at chunk_rate chunks per second.
+
+    A fraction error_rate of the requests fails with openai.error.ServiceUnavailableError, a transient error. Whether
+    a request fails depends only on the seed, its messages and how many times they were sent before, so runs are
+    reproducible regardless of thread scheduling. calls counts the requests received.
+
+    Parameters:
+    latency (float, optional): The time to the first token in seconds. Defaults to 0.05.
+    chunk_rate (float, optional): The streamed chunks per second; None streams without delay. Defaults to None.
+    error_rate (float, optional): The fraction of failed requests. Defaults to 0.0.
+    seed (int, optional): The seed of the failures. Defaults to 0.
+    respond (function, optional): Computes the answer from the messages. Defaults to echoing the last message.
+    """
+
+    def __init__(self, latency=0.05, chunk_rate=None, error_rate=0.0, seed=0, respond=None):
+        self.latency = latency
+        self.chunk_rate = chunk_rate
+        self.error_rate = error_rate
+        self.seed = seed
+        self.respond = respond or (lambda messages: messages[-1]["content"])
+        self.attempts = {}
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def complete(self, messages, model, temperature, max_tokens, streaming, request_timeout, timing):
+        key = cache_module.hash_key(str(self.seed) + "\n" + model + "\n" + json.dumps(messages, sort_keys=True))
+        with self.lock:
+            self.calls += 1
+            attempt = self.attempts.get(key, 0)
+            self.attempts[key] = attempt + 1
+        start = time.perf_counter()
+        time.sleep(self.latency)
+        if random.Random(key + str(attempt)).random() < self.error_rate:
+            import openai
+
+            raise openai.error.ServiceUnavailableError("Mock backend failure", http_status=503)
+
+        res = self.respond(messages)
+        if timing is not None:
+            timing["ttft"] = time.perf_counter() - start
+        if streaming and self.chunk_rate:
+            for _ in range(len(res.split(" ")) - 1):
+                time.sleep(1 / self.chunk_rate)
+        if timing is not None:
+            timing["latency"] = time.perf_counter() - start
         return res
 
-    res = completion["choices"][0]["message"]["content"]
 
-    return res
+default_backend = OpenAIBackend()
+backends = {}
 
 
-def call_llm(cache, messages, model="gpt-3.5-turbo", temperature=0.0, max_tokens=1000, streaming=True):
+def set_backend(model, backend):
+    """
+    Routes the requests of a model to a backend (see OpenAIBackend). A backend of None restores default_backend.
+    """
+    if backend is None:
+        backends.pop(model, None)
+    else:
+        backends[model] = backend
+
+
+def get_backend(model):
+    """
+    Returns the backend that serves a model: the one registered with set_backend, or default_backend.
+    """
+    return backends.get(model, default_backend)
+
+
+telemetry_hooks = []
+
+
+def add_telemetry_hook(hook):
+    """
+    Registers a function that call_llm calls with the telemetry record of every call (see call_llm). Hooks run in
+    the calling thread and must be thread-safe.
+    """
+    telemetry_hooks.append(hook)
+
+
+def remove_telemetry_hook(hook):
+    """
+    Unregisters a function registered with add_telemetry_hook.
+    """
+    telemetry_hooks.remove(hook)
+
+
+def summarize_telemetry(records, wall_time):
+    """
+    Aggregates the telemetry records of a batch of call_llm calls the way reports store them.
+
+    Parameters:
+    records (list of dict): The telemetry records.
+    wall_time (float): The wall-clock time of the batch in seconds.
+
+    Returns:
+    dict: The number of "calls", "cache_hits" and "retries", the total "prompt_tokens" and "completion_tokens", the
+    "average", "p50", "p90" and "p99" of the "latency" and of the "ttft" (time to first token) in seconds, the
+    "wall_time" and the "throughput" in "calls_per_second" and "completion_tokens_per_second". Latencies of cache
+    hits are those of the API calls that produced the completions, where recorded.
+    """
+
+    def percentiles(values):
+        values = sorted(value for value in values if value is not None)
+        if not values:
+            return None
+        return {
+            "average": sum(values) / len(values),
+            "p50": values[min(len(values) - 1, int(len(values) * 0.5))],
+            "p90": values[min(len(values) - 1, int(len(values) * 0.9))],
+            "p99": values[min(len(values) - 1, int(len(values) * 0.99))]
+        }
+
+    completion_tokens = sum(record["completion_tokens"] for record in records)
+    return {
+        "calls": len(records),
+        "cache_hits": sum(1 for record in records if record["cache_hit"]),
+        "retries": sum(max(0, record["attempts"] - 1) for record in records),
+        "prompt_tokens": sum(record["prompt_tokens"] for record in records),
+        "completion_tokens": completion_tokens,
+        "latency": percentiles(record["latency"] for record in records),
+        "ttft": percentiles(record["ttft"] for record in records),
+        "wall_time": wall_time,
+        "throughput": {
+            "calls_per_second": len(records) / wall_time if wall_time > 0 else None,
+            "completion_tokens_per_second": completion_tokens / wall_time if wall_time > 0 else None
+        }
+    }
+
+
+def record_telemetry(cache, record, telemetry):
+    """
+    Passes a telemetry record of call_llm to the cache's telemetry table, the telemetry list of the caller and the
+    registered hooks.
+    """
+    if cache is not None:
+        cache.record_telemetry(record)
+    if telemetry is not None:
+        telemetry.append(record)
+    for hook in telemetry_hooks:
+        hook(record)
+
+
+def call_hedged(function, hedge_after):
+    """
+    Calls function() and, if it has not returned after hedge_after seconds, calls it a second time in parallel.
+    Returns the result of whichever call succeeds first, and raises the first error only if both calls fail.
+    """
+    executor = ThreadPoolExecutor(max_workers=2)
+    try:
+        futures = [executor.submit(function)]
+        done, _ = wait(futures, timeout=hedge_after)
+        if not done:
+            futures.append(executor.submit(function))
+        error = None
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = error or future.exception()
+        raise error
+    finally:
+        executor.shutdown(wait=False)
+
+
+def call_llm(cache, messages, model="gpt-3.5-turbo", temperature=0.0, max_tokens=1000, streaming=True,
+             request_timeout=REQUEST_TIMEOUT, hedge_after=None, telemetry=None):
     """
     Fetches responses from the ChatGPT API for a given set of messages, using caching and automatic retries in case of
-    errors. If the responses for the same set of messages and model are found in the cache, those are returned instead
-    of making another API call. If not, the function makes an API call to fetch the responses and then stores them in
-    the cache for future reference.
+    errors. If the responses for the same set of messages, model, temperature and max tokens are found in the cache,
+    those are returned instead of making another API call. If not, the function makes an API call to fetch the
+    responses and then stores them in the cache for future reference.
 
     Parameters:
-    cache (dict): A dictionary used to store the responses. Key is formed by model name and messages. If None, no
-                      caching is done.
+    cache (cache.ChatCompletionCache): The completion cache, keyed by model name, messages, temperature and max
+                      tokens. If None, no caching is done.
     messages (list of dict): A list of message-role-content dictionaries that represent a conversation.
     model (str, optional): The ID of the model to use. Defaults to "gpt-3.5-turbo".
     temperature (float, optional): Controls the randomness of the model's output. A higher value makes the output more
                                         random, while a lower value makes it more deterministic. Defaults to 0.0.
     max_tokens (int, optional): The maximum length of the model's output. Defaults to 1000.
     streaming (bool, optional): Whether to stream the output from the model or not. Defaults to True.
+    request_timeout (float, optional): The timeout of a single request in seconds. Defaults to REQUEST_TIMEOUT.
+    hedge_after (float, optional): If set, a second identical request is sent when the first one has not returned
+                                        after this many seconds, and the first response wins. Defaults to None.
+    telemetry (list, optional): If given, the telemetry record of the call is appended to it. Defaults to None.
 
     Returns:
     str: The model's output for the given set of messages.
 
     Raises:
-    Exception: Any exception that might occur during the API call. The function will automatically retry after 60 seconds.
+    Exception: A fatal error (see classify_error) as soon as it occurs, or the last error once
+               RETRY_POLICY["max_attempts"] attempts have failed. Rate limit and transient errors are retried with
+               exponential backoff and jitter (see get_backoff_delay), honouring Retry-After hints. While the model's
+               circuit breaker is open, calls wait instead of sending requests.
 
     Note:
-    This function requires the "OPENAI_API_KEY" environment variable to be set.
-    The function also writes to a SQLite3 database located at "..//data//llm_cache.sqlite3".
+    Requests are sent to the model's backend (see get_backend). The OpenAI backend requires the "OPENAI_API_KEY"
+    environment variable to be set.
+    New completions are written to the cache database through cache.put().
+    It is safe to call from several threads.
+    API calls are paced by the shared rate_limiter according to the limits configured in RATE_LIMITS.
+    Every call produces a telemetry record: a dictionary with the cache "key_hash", "model", "timestamp",
+    "cache_hit", "ttft" and "latency" in seconds, estimated "prompt_tokens" and "completion_tokens" and the number of
+    "attempts". It is written to the cache's telemetry table and passed to the telemetry hooks (see
+    add_telemetry_hook). For cache hits, ttft and latency are those of the API call that produced the completion,
+    or None if it was not recorded, and attempts is 0.
     """
 
+    parameters = {"temperature": temperature, "max_tokens": max_tokens}
+    key_hash = cache_module.hash_key(cache_module.make_key(model, messages, parameters))
+    record = {
+        "key_hash": key_hash,
+        "model": model,
+        "timestamp": time.time(),
+        "cache_hit": False,
+        "ttft": None,
+        "latency": None,
+        "prompt_tokens": estimate_tokens(messages),
+        "completion_tokens": 0,
+        "attempts": 0
+    }
     if cache is not None:
-        key = model + "\n" + json.dumps(messages, indent=4, ensure_ascii=False)
-        if key in cache:
-            return cache[key]
+        cached = cache.get(model, messages, parameters)
+        if cached is not None:
+            original = cache.lookup_telemetry(key_hash)
+            if original is not None:
+                record.update(ttft=original["ttft"], latency=original["latency"])
+            record.update(cache_hit=True, completion_tokens=count_tokens(cached))
+            record_telemetry(cache, record, telemetry)
+            return cached
+
+    backend = get_backend(model)
+    circuit_breaker = get_circuit_breaker(model)
 
-    openai.api_key = os.environ.get("OPENAI_API_KEY")
-    while True:
+    def attempt():
+        rate_limiter.acquire(model, record["prompt_tokens"] + max_tokens)
+        timing = {}
+        res = backend.complete(messages, model, temperature, max_tokens, streaming, request_timeout, timing)
+        return res, timing
+
+    for attempt_number in range(RETRY_POLICY["max_attempts"]):
+        circuit_breaker.before_call()
+        record["attempts"] = attempt_number + 1
         try:
-            res = call_chatgpt_on_messages(messages, model=model, temperature=temperature, max_tokens=max_tokens,
-                                           streaming=streaming)
-            if cache is not None:
-                cache[key] = res
-                conn = sqlite3.connect("..//data//llm_cache.sqlite3")
-                cursor = conn.cursor()
-                cursor.execute("INSERT INTO chat_completion (model, prompt, completion) VALUES (?, ?, ?)",
-                               (model, json.dumps(messages, indent=4, ensure_ascii=False), res))
-                conn.commit()
-                conn.close()
-            return res
+            res, timing = attempt() if hedge_after is None else call_hedged(attempt, hedge_after)
         except Exception as e:
-            time.sleep(60)
-            print(f"An error occurred: {e}. Retrying...")
+            kind = classify_error(e)
+            if kind == "fatal":
+                # The request or the code is wrong, not the model: do not count it against the circuit.
+                circuit_breaker.record_success()
+                raise
+            circuit_breaker.record_failure()
+            if attempt_number == RETRY_POLICY["max_attempts"] - 1:
+                raise
+            delay = get_backoff_delay(attempt_number, e)
+            logger.warning("An error occurred (%s): %s. Retrying in %.1fs...", kind, e, delay)
+            time.sleep(delay)
+            continue
+        circuit_breaker.record_success()
+        record.update(ttft=timing["ttft"], latency=timing["latency"], completion_tokens=count_tokens(res))
+        if cache is not None:
+            cache.put(model, messages, res, parameters)
+        record_telemetry(cache, record, telemetry)
+        return res
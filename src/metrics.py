@@ -1,5 +1,18 @@
-from nltk.translate.bleu_score import sentence_bleu
-from nltk.tokenize import word_tokenize
+import math
+import sys
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+import numpy as np
+
+# Batches with at least this many pairs are scored in a process pool by calculate_metrics.
+PARALLEL_THRESHOLD = 5000
+
+# The maximum n-gram order of BLEU and of chrF.
+BLEU_ORDER = 4
+CHRF_ORDER = 6
+CHRF_BETA = 2
 
 
 def calculate_metric(expected, actual, metric):
@@ -9,13 +22,15 @@ def calculate_metric(expected, actual, metric):
     Parameters:
     expected (str): The original sentence.
     actual (str): The generated sentence.
-    metric (str): The type of metric to calculate. Currently, only 'bleu' is supported.
+    metric (str): The type of metric to calculate: 'bleu' or 'chrf'.
 
     Returns:
     float: The calculated metric. Returns None if the metric type is not supported.
     """
     if metric == "bleu":
         return calculate_bleu(expected, actual)
+    if metric == "chrf":
+        return calculate_chrf(expected, actual)
 
 
 def calculate_bleu(expected, actual):
@@ -30,12 +45,211 @@ def calculate_bleu(expected, actual):
     float: The BLEU score for the two sentences. A higher score indicates a closer match to the original sentence.
 
     Note:
-    Punctuation marks ('.', ',', '?', '!') are removed before calculating the BLEU score.
-    """
-    tokenized_reference = word_tokenize(expected.lower())
-    tokenized_candidate = word_tokenize(actual.lower())
-    tokenized_reference = [e for e in tokenized_reference if e not in ('.', ',', '?', '!')]
-    tokenized_candidate = [e for e in tokenized_candidate if e not in ('.', ',', '?', '!')]
-    reference_list = [tokenized_reference]
-    bleu_score = sentence_bleu(reference_list, tokenized_candidate)
-    return bleu_score
+    Punctuation marks ('.', ',', '?', '!') are removed before calculating the BLEU score. The score is the same as
+    NLTK's sentence_bleu with default weights and no smoothing.
+    """
+    return float(bleu_scores(bleu_statistics([expected], [actual]))[0])
+
+
+def calculate_chrf(expected, actual):
+    """
+    This function calculates the chrF score (character n-gram F-score, n up to 6, beta = 2) for comparing two
+    sentences. Whitespace is ignored.
+
+    Returns:
+    float: The chrF score between 0 and 1.
+    """
+    return float(chrf_scores(chrf_statistics([expected], [actual]))[0])
+
+
+def calculate_metrics(expected_list, actual_list, metric, processes=None):
+    """
+    Calculates a sentence-level metric for every pair of a batch. Tokenizations and reference n-gram counts are
+    memoized, the scores are computed with NumPy over the whole batch, and batches of at least PARALLEL_THRESHOLD
+    pairs are split across a process pool.
+
+    Parameters:
+    expected_list (list of str): The original sentences.
+    actual_list (list of str): The generated sentences.
+    metric (str): 'bleu' or 'chrf'.
+    processes (int, optional): The number of worker processes for large batches. Defaults to the number of CPUs;
+        1 disables the pool.
+
+    Returns:
+    list of float: The score of each pair, equal to calculate_metric on that pair.
+    """
+    return list(np.asarray(metric_scores(metric_statistics(expected_list, actual_list, metric, processes), metric),
+                           dtype=float))
+
+
+def calculate_corpus_metric(expected_list, actual_list, metric, processes=None):
+    """
+    Calculates a corpus-level metric over a batch: the n-gram statistics of all pairs are added up before the score
+    is computed, as in NLTK's corpus_bleu. Parameters are as in calculate_metrics.
+
+    Returns:
+    float: The corpus-level score.
+    """
+    statistics = metric_statistics(expected_list, actual_list, metric, processes)
+    return float(metric_scores(statistics.sum(axis=0, keepdims=True), metric)[0])
+
+
+def summarize_scores(values):
+    """
+    Summarizes a list of scores the way reports store them.
+
+    Returns:
+    dict: The "average", "median" and "std" of the scores and their "percentiles" (10, 20, 25, 30, 40, 50, 60, 70, 75,
+    80 and 90), keyed by percentile as a string.
+    """
+    percentile_ranks = [10, 20, 25, 30, 40, 50, 60, 70, 75, 80, 90]
+    percentiles = np.percentile(values, percentile_ranks)
+    return {
+        "average": np.average(values),
+        "median": np.median(values),
+        "std": np.std(values),
+        "percentiles": {str(rank): percentiles[i] for i, rank in enumerate(percentile_ranks)}
+    }
+
+
+def metric_scores(statistics, metric):
+    """
+    Computes sentence-level scores from rows of metric_statistics. Rows summed over a corpus give the corpus-level
+    score.
+    """
+    if metric == "bleu":
+        return bleu_scores(statistics)
+    if metric == "chrf":
+        return chrf_scores(statistics)
+    raise ValueError("Unsupported metric: " + metric)
+
+
+def metric_statistics(expected_list, actual_list, metric, processes=None):
+    """
+    Computes the sufficient statistics of a metric (bleu_statistics or chrf_statistics) for every pair of a batch,
+    in a process pool for batches of at least PARALLEL_THRESHOLD pairs. Parameters are as in calculate_metrics.
+    """
+    if len(expected_list) != len(actual_list):
+        raise ValueError("expected_list and actual_list must have the same length")
+    statistics_function = bleu_statistics if metric == "bleu" else chrf_statistics
+    if len(expected_list) < PARALLEL_THRESHOLD or processes == 1:
+        return statistics_function(expected_list, actual_list)
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        chunk_size = math.ceil(len(expected_list) / executor._max_workers)
+        chunks = [(expected_list[i:i + chunk_size], actual_list[i:i + chunk_size])
+                  for i in range(0, len(expected_list), chunk_size)]
+        results = executor.map(statistics_function, [chunk[0] for chunk in chunks], [chunk[1] for chunk in chunks])
+        return np.concatenate(list(results))
+
+
+def word_tokenize(text):
+    """
+    NLTK's word_tokenize. NLTK is imported on first use, so metrics that do not tokenize words (chrF) and modules that
+    only import this one do not pay for it.
+    """
+    from nltk.tokenize import word_tokenize as nltk_word_tokenize
+
+    return nltk_word_tokenize(text)
+
+
+@lru_cache(maxsize=65536)
+def tokenize(sentence):
+    """
+    Lowercases and tokenizes a sentence with NLTK's word_tokenize and removes the punctuation marks '.', ',', '?' and
+    '!'. The result is memoized.
+    """
+    return tuple(e for e in word_tokenize(sentence.lower()) if e not in ('.', ',', '?', '!'))
+
+
+def _ngram_counts(items, order):
+    # Slices of a token tuple are tuples and slices of a string are strings, so both can be counted directly.
+    return [Counter(items[i:i + n] for i in range(len(items) - n + 1)) for n in range(1, order + 1)]
+
+
+@lru_cache(maxsize=65536)
+def _reference_ngrams(sentence):
+    tokens = tokenize(sentence)
+    return len(tokens), _ngram_counts(tokens, BLEU_ORDER)
+
+
+@lru_cache(maxsize=65536)
+def _character_ngrams(sentence):
+    return _ngram_counts("".join(sentence.split()), CHRF_ORDER)
+
+
+def bleu_statistics(expected_list, actual_list):
+    """
+    Computes the BLEU sufficient statistics of every pair: for each n-gram order the clipped matches and the number of
+    candidate n-grams (at least 1), followed by the candidate length and the reference length.
+
+    Returns:
+    numpy.ndarray: An array of shape (len(expected_list), 2 * BLEU_ORDER + 2).
+    """
+    res = np.zeros((len(expected_list), 2 * BLEU_ORDER + 2))
+    for row, (expected, actual) in enumerate(zip(expected_list, actual_list)):
+        reference_length, reference_counts = _reference_ngrams(expected)
+        candidate = tokenize(actual)
+        for n, counts in enumerate(_ngram_counts(candidate, BLEU_ORDER)):
+            res[row, n] = sum(min(count, reference_counts[n][ngram]) for ngram, count in counts.items())
+            res[row, BLEU_ORDER + n] = max(1, sum(counts.values()))
+        res[row, 2 * BLEU_ORDER] = len(candidate)
+        res[row, 2 * BLEU_ORDER + 1] = reference_length
+    return res
+
+
+def bleu_scores(statistics):
+    """
+    Computes BLEU scores from rows of bleu_statistics, with uniform weights and no smoothing: a precision without
+    matches counts as sys.float_info.min, and a score is 0 if there are no unigram matches.
+    """
+    numerators = statistics[:, :BLEU_ORDER]
+    denominators = statistics[:, BLEU_ORDER:2 * BLEU_ORDER]
+    candidate_lengths = statistics[:, 2 * BLEU_ORDER]
+    reference_lengths = statistics[:, 2 * BLEU_ORDER + 1]
+
+    precisions = np.where(numerators > 0, numerators / denominators, sys.float_info.min)
+    log_average = np.log(precisions).sum(axis=1) / BLEU_ORDER
+    with np.errstate(divide="ignore", invalid="ignore"):
+        brevity_penalty = np.where(candidate_lengths > reference_lengths, 1.0,
+                                   np.exp(1 - reference_lengths / candidate_lengths))
+    return np.where(numerators[:, 0] > 0, brevity_penalty * np.exp(log_average), 0.0)
+
+
+def chrf_statistics(expected_list, actual_list):
+    """
+    Computes the chrF sufficient statistics of every pair: for each character n-gram order the matches, the number of
+    candidate n-grams and the number of reference n-grams. Whitespace is removed first. The character n-gram counts
+    of each sentence are memoized.
+
+    Returns:
+    numpy.ndarray: An array of shape (len(expected_list), 3 * CHRF_ORDER).
+    """
+    res = np.zeros((len(expected_list), 3 * CHRF_ORDER))
+    for row, (expected, actual) in enumerate(zip(expected_list, actual_list)):
+        reference_counts = _character_ngrams(expected)
+        candidate_counts = _character_ngrams(actual)
+        for n in range(CHRF_ORDER):
+            smaller, larger = sorted((candidate_counts[n], reference_counts[n]), key=len)
+            res[row, n] = sum(min(count, larger.get(ngram, 0)) for ngram, count in smaller.items())
+            res[row, CHRF_ORDER + n] = sum(candidate_counts[n].values())
+            res[row, 2 * CHRF_ORDER + n] = sum(reference_counts[n].values())
+    return res
+
+
+def chrf_scores(statistics):
+    """
+    Computes chrF scores from rows of chrf_statistics: character n-gram precision and recall are averaged over the
+    orders present in both sentences and combined into an F-score with beta = CHRF_BETA.
+    """
+    matches = statistics[:, :CHRF_ORDER]
+    candidate_counts = statistics[:, CHRF_ORDER:2 * CHRF_ORDER]
+    reference_counts = statistics[:, 2 * CHRF_ORDER:]
+
+    present = (candidate_counts > 0) & (reference_counts > 0)
+    orders = present.sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        precision = np.where(present, matches / candidate_counts, 0.0).sum(axis=1) / orders
+        recall = np.where(present, matches / reference_counts, 0.0).sum(axis=1) / orders
+        f_score = (1 + CHRF_BETA ** 2) * precision * recall / (CHRF_BETA ** 2 * precision + recall)
+    return np.where((orders > 0) & (precision + recall > 0), f_score, 0.0)
@@ -0,0 +1,103 @@
+import logging
+import math
+import random
+
+import create_reports
+import llm
+
+logger = logging.getLogger(__name__)
+
+
+def successive_halving(project, model, system_message_files, parameters, ks, metric, orderings=1, initial_size=12,
+                       eta=2, max_workers=8, verify=False, seed=0, k_unit="chars"):
+    """
+    Searches for the best prompt among candidates (system message file x k x example ordering) with successive
+    halving: every surviving candidate is evaluated on a growing prefix of a shuffled test set, and after each round
+    only the best 1/eta of them, by average score, go on to a test subset eta times larger. Test examples already
+    evaluated for a candidate are not evaluated again, so the budget is spent on the contenders.
+
+    Parameters:
+    project, model, parameters, metric, k_unit: As in create_reports.create_report.
+    system_message_files (list of str): The system message files to compare.
+    ks (list of int): The example budgets to compare.
+    orderings (int, optional): The number of example orderings per (system message, k); ordering q is the q-th
+        repetition of create_report. Defaults to 1.
+    initial_size (int, optional): The number of test examples of the first round. Defaults to 12.
+    eta (int, optional): The factor by which candidates are cut and the subset grows each round. Defaults to 2.
+    max_workers (int, optional): The maximum number of concurrent LLM calls. Defaults to 8.
+    verify (bool, optional): Whether to also evaluate every candidate on the full test set and check that the
+        exhaustive search finds the same winner. Defaults to False.
+    seed (int, optional): The seed of the test set shuffle. Defaults to 0.
+
+    Returns:
+    dict: The "winner" as a (system_message_file, k, ordering) tuple, its "average" score on the examples it was
+    evaluated on, the number of test "calls" made, the number of "exhaustive_calls" of the full grid and the calls
+    "saved". With verify, also the "exhaustive_winner" and whether it is the "same_winner".
+    """
+    cache = llm.get_chat_completion_cache()
+    candidates = {}
+    test = None
+    for system_message_file in system_message_files:
+        for k in ks:
+            for q in range(orderings):
+                prompt, candidate_test = create_reports.build_prompt(project, system_message_file, parameters, k, q,
+                                                                     k_unit)
+                candidates[(system_message_file, k, q)] = {"prompt": prompt, "scores": []}
+                test = candidate_test
+    random.Random(seed).shuffle(test)
+
+    def evaluate(candidate, size):
+        scores = candidates[candidate]["scores"]
+        if len(scores) >= size:
+            return 0
+        examples = [dict(example) for example in test[len(scores):size]]
+        create_reports.evaluate_tests(cache, candidates[candidate]["prompt"], examples, model, metric,
+                                      max_workers=max_workers)
+        scores.extend(example["score"] for example in examples)
+        return len(examples)
+
+    def average(candidate):
+        scores = candidates[candidate]["scores"]
+        return sum(scores) / len(scores)
+
+    calls = 0
+    survivors = list(candidates)
+    size = min(initial_size, len(test))
+    while True:
+        for candidate in survivors:
+            calls += evaluate(candidate, size)
+        survivors.sort(key=average, reverse=True)
+        logger.info("Successive halving: %d candidates on %d examples, best %s average %.3f", len(survivors), size,
+                    survivors[0], average(survivors[0]))
+        if len(survivors) == 1 or size >= len(test):
+            break
+        survivors = survivors[:max(1, math.ceil(len(survivors) / eta))]
+        size = min(size * eta, len(test))
+
+    winner = survivors[0]
+    res = {
+        "winner": winner,
+        "average": average(winner),
+        "calls": calls,
+        "exhaustive_calls": len(candidates) * len(test),
+        "saved": len(candidates) * len(test) - calls
+    }
+    logger.info("Winner %s with average %.3f after %d calls, %d fewer than the exhaustive grid of %d", winner,
+                res["average"], calls, res["saved"], res["exhaustive_calls"])
+
+    if verify:
+        for candidate in candidates:
+            evaluate(candidate, len(test))
+        res["exhaustive_winner"] = max(candidates, key=average)
+        res["same_winner"] = res["exhaustive_winner"] == winner
+        logger.info("Exhaustive winner %s with average %.3f: %s winner", res["exhaustive_winner"],
+                    average(res["exhaustive_winner"]), "same" if res["same_winner"] else "different")
+
+    cache.close()
+    return res
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    successive_halving("grammar_correction", "gpt-3.5-turbo", ["1", "2", "3", "4", "5", "6"],
+                       {"language": "English"}, [0, 2000], "bleu", orderings=2, verify=True)
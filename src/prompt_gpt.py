@@ -0,0 +1,149 @@
+import argparse
+import json
+import logging
+import sys
+
+import config
+
+# The modules each subcommand imports when it runs. Nothing heavy (openai, nltk, numpy, matplotlib) is imported
+# before a subcommand needs it: 'cache' imports none of them, 'report' and 'sweep' import openai only for uncached
+# calls and nltk only for BLEU, and only 'visualize' imports matplotlib.
+SUBCOMMAND_MODULES = {
+    "report": ["create_reports"],
+    "sweep": ["sweep", "create_reports"],
+    "visualize": ["visualize"],
+    "rescore": ["rescore"],
+    "cache": ["cache"],
+}
+
+# Startup time target of every subcommand in seconds: interpreter start plus the imports above, as measured by
+# benchmarks.benchmark_cli_startup.
+STARTUP_TARGET_SECONDS = 0.5
+
+
+def parse_parameters(values):
+    """
+    Parses "name=value" command line arguments into a parameter dictionary.
+    """
+    res = {}
+    for value in values or []:
+        name, separator, parameter = value.partition("=")
+        if not separator:
+            raise argparse.ArgumentTypeError("Parameters must be given as name=value: " + value)
+        res[name] = parameter
+    return res
+
+
+def run_report(arguments):
+    import create_reports
+
+    res = create_reports.create_report(arguments.project, arguments.model, arguments.system_message_file,
+                                       parse_parameters(arguments.param), arguments.k, arguments.metric,
+                                       n=arguments.n, max_workers=arguments.workers, plan=arguments.plan,
+                                       pack_size=arguments.pack_size, k_unit=arguments.k_unit)
+    if arguments.plan:
+        print(json.dumps(res, indent=4))
+
+
+def run_sweep(arguments):
+    import create_reports
+    import sweep
+
+    with open(arguments.specs, "r", encoding="utf-8") as f:
+        specs = json.load(f)
+    if arguments.plan:
+        create_reports.plan_sweep([configuration for spec in specs for configuration in sweep.expand_spec(spec)],
+                                  max_workers=arguments.workers)
+    else:
+        sweep.run_sweep(specs, max_workers=arguments.workers, checkpoint_path=arguments.checkpoint)
+
+
+def run_visualize(arguments):
+    import visualize
+
+    visualize.visualize(arguments.project, arguments.system, arguments.model,
+                        [json.loads(parameters) for parameters in arguments.params], arguments.k, arguments.metric,
+                        output=arguments.output, k_unit=arguments.k_unit)
+
+
+def run_rescore(arguments):
+    import rescore
+
+    rescore.rescore(arguments.project, arguments.metrics, processes=arguments.processes, force=arguments.force)
+
+
+def run_cache_stats(arguments):
+    import cache
+
+    print(json.dumps(cache.get_cache_stats(arguments.path), indent=4))
+
+
+def build_parser():
+    """
+    Builds the argument parser of the prompt_gpt command line.
+    """
+    parser = argparse.ArgumentParser(prog="prompt_gpt", description="Measures and optimizes prompts for seq2seq "
+                                                                    "tasks solved with LLMs.")
+    parser.add_argument("--data-dir", help="the data directory (default: $" + config.DATA_DIR_VARIABLE +
+                                           " or the repository's 'data' directory)")
+    parser.add_argument("-v", "--verbose", action="count", default=0, help="log INFO (-v) or DEBUG (-vv) messages")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    report = subparsers.add_parser("report", help="evaluate one prompt configuration and save its report")
+    report.add_argument("project")
+    report.add_argument("model")
+    report.add_argument("system_message_file", help="name of the system message file, without .txt")
+    report.add_argument("-k", type=int, required=True, help="size of the few-shot examples")
+    report.add_argument("--metric", default="bleu", choices=["bleu", "chrf"])
+    report.add_argument("--param", action="append", metavar="NAME=VALUE", help="dataset parameter (repeatable)")
+    report.add_argument("-n", type=int, default=1, help="number of repetitions")
+    report.add_argument("--workers", type=int, default=1, help="concurrent LLM calls")
+    report.add_argument("--pack-size", type=int, default=1, help="test examples per request")
+    report.add_argument("--k-unit", default="chars", choices=["chars", "tokens"])
+    report.add_argument("--plan", action="store_true", help="only estimate calls, cost and runtime")
+    report.set_defaults(function=run_report)
+
+    sweep = subparsers.add_parser("sweep", help="run the reports of sweep specs, resumably")
+    sweep.add_argument("specs", help="JSON file with a list of sweep specs")
+    sweep.add_argument("--workers", type=int, default=8, help="concurrent LLM calls")
+    sweep.add_argument("--checkpoint", help="checkpoint file (default: sweep_checkpoint.jsonl in the data directory)")
+    sweep.add_argument("--plan", action="store_true", help="only estimate calls, cost and runtime")
+    sweep.set_defaults(function=run_sweep)
+
+    visualize = subparsers.add_parser("visualize", help="plot the scores of stored reports")
+    visualize.add_argument("project")
+    visualize.add_argument("--system", nargs="+", required=True, help="system message files")
+    visualize.add_argument("--model", nargs="+", required=True, help="models")
+    visualize.add_argument("--params", nargs="+", required=True, metavar="JSON", help="parameter configurations")
+    visualize.add_argument("-k", type=int, nargs="+", required=True, help="example sizes")
+    visualize.add_argument("--metric", default="bleu")
+    visualize.add_argument("--k-unit", default="chars", choices=["chars", "tokens"])
+    visualize.add_argument("--output", help="save the plot to this file instead of showing it")
+    visualize.set_defaults(function=run_visualize)
+
+    rescore = subparsers.add_parser("rescore", help="add metrics to existing reports without calling the model")
+    rescore.add_argument("project")
+    rescore.add_argument("metrics", nargs="+", choices=["bleu", "chrf"])
+    rescore.add_argument("--processes", type=int, help="worker processes for large batches")
+    rescore.add_argument("--force", action="store_true", help="recompute metrics that are already present")
+    rescore.set_defaults(function=run_rescore)
+
+    cache = subparsers.add_parser("cache", help="inspect the completion cache")
+    cache_subparsers = cache.add_subparsers(dest="cache_command", required=True)
+    stats = cache_subparsers.add_parser("stats", help="print entry counts, sizes and per-model telemetry")
+    stats.add_argument("--path", help="cache database (default: llm_cache.sqlite3 in the data directory)")
+    stats.set_defaults(function=run_cache_stats)
+    return parser
+
+
+def main(argv=None):
+    arguments = build_parser().parse_args(argv)
+    logging.basicConfig(level=[logging.WARNING, logging.INFO, logging.DEBUG][min(arguments.verbose, 2)],
+                        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    if arguments.data_dir:
+        config.set_data_dir(arguments.data_dir)
+    arguments.function(arguments)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,225 @@
+import json
+import os
+import sqlite3
+
+import config
+
+
+def get_report_store_path(project):
+    """
+    Returns the path of the report store database of a project.
+    """
+    return config.data_path(project, "reports.sqlite3")
+
+
+# Report keys kept out of the summary, in the details column: they are large or only needed by load(). The summary
+# keeps them, and "tests", as null placeholders so that load() restores the key order of the report.
+DETAIL_KEYS = ("prompt", "telemetry")
+
+
+def encode_parameters(parameters):
+    """
+    Returns the canonical JSON string of a parameter dictionary, as stored in and queried from the report store.
+    """
+    return json.dumps(parameters, sort_keys=True, ensure_ascii=False)
+
+
+class ReportStore:
+    """
+    Report store of a project, kept in a SQLite3 database next to its 'reports' directory. It has two tables:
+
+    report: one row per report, keyed by its report name (see create_reports.get_report_name), with the
+        configuration (system message file, model, parameters, k, k unit, metric) and the summary statistics in
+        indexed columns, the prompt and the telemetry (DETAIL_KEYS) as JSON in the details column, and everything
+        else except the tests as JSON in the summary column.
+    test_score: one row per test example of a report, with its score and the example as JSON.
+
+    Queries by configuration read only the summary of the report table, and the scores of a report only its
+    test_score rows, so prompts and model outputs are not loaded unless a full report is requested with load().
+
+    Parameters:
+    project (str): The name of the project.
+    path (str, optional): The path of the database. Defaults to get_report_store_path(project).
+    """
+
+    def __init__(self, project, path=None):
+        self.project = project
+        self.path = path or get_report_store_path(project)
+        self.conn = sqlite3.connect(self.path, timeout=30.0)
+        self.conn.execute("PRAGMA journal_mode=" + config.get_journal_mode())
+        self.conn.execute("CREATE TABLE IF NOT EXISTS report "
+                          "(id INTEGER PRIMARY KEY, name TEXT UNIQUE, system_message_file TEXT, model TEXT, "
+                          "parameters TEXT, k INTEGER, k_unit TEXT, metric TEXT, average REAL, median REAL, std REAL, "
+                          "n_tests INTEGER, summary TEXT, details TEXT)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS report_configuration "
+                          "ON report (metric, model, system_message_file, k)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS test_score "
+                          "(report_id INTEGER, position INTEGER, score REAL, test TEXT, "
+                          "PRIMARY KEY (report_id, position))")
+        self._migrate_details()
+        self.conn.commit()
+
+    def _migrate_details(self):
+        # Stores written before the details column kept the prompt and the telemetry in the summary.
+        if "details" not in [row[1] for row in self.conn.execute("PRAGMA table_info(report)")]:
+            self.conn.execute("ALTER TABLE report ADD COLUMN details TEXT")
+        rows = self.conn.execute("SELECT id, summary FROM report WHERE details IS NULL").fetchall()
+        updates = []
+        for report_id, summary in rows:
+            summary = json.loads(summary)
+            details = {key: summary[key] for key in DETAIL_KEYS if key in summary}
+            summary.update(dict.fromkeys(details))
+            updates.append((json.dumps(summary, ensure_ascii=False), json.dumps(details, ensure_ascii=False),
+                            report_id))
+        self.conn.executemany("UPDATE report SET summary = ?, details = ? WHERE id = ?", updates)
+
+    def save(self, name, report):
+        """
+        Stores a report under its report name, replacing the report previously stored under that name.
+        """
+        summary = {key: None if key in DETAIL_KEYS or key == "tests" else value for key, value in report.items()}
+        details = {key: report[key] for key in DETAIL_KEYS if key in report}
+        with self.conn:
+            row = self.conn.execute("SELECT id FROM report WHERE name = ?", (name,)).fetchone()
+            if row is not None:
+                self.conn.execute("DELETE FROM test_score WHERE report_id = ?", (row[0],))
+                self.conn.execute("DELETE FROM report WHERE id = ?", (row[0],))
+            report_id = self.conn.execute(
+                "INSERT INTO report (name, system_message_file, model, parameters, k, k_unit, metric, average, "
+                "median, std, n_tests, summary, details) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (name, report["system_message_file"], report["model"], encode_parameters(report["parameters"]),
+                 report["k"], report.get("k_unit", "chars"), report["metric"], float(report["average"]),
+                 float(report["median"]), float(report["std"]), report.get("n_tests", len(report["tests"])),
+                 json.dumps(summary, ensure_ascii=False), json.dumps(details, ensure_ascii=False))).lastrowid
+            self.conn.executemany("INSERT INTO test_score (report_id, position, score, test) VALUES (?, ?, ?, ?)",
+                                  [(report_id, position, float(test["score"]), json.dumps(test, ensure_ascii=False))
+                                   for position, test in enumerate(report["tests"])])
+
+    def query(self, system_message_files=None, models=None, parameters_configurations=None, ks=None, metric=None,
+              k_unit=None):
+        """
+        Returns the summaries of the stored reports that match every given filter, ordered by k and report name.
+        A filter that is None matches everything.
+
+        Parameters:
+        system_message_files, models, parameters_configurations, ks (list, optional): The accepted values.
+        metric, k_unit (str, optional): The metric and the unit of k.
+
+        Returns:
+        list of dict: The report summaries (every key of the report except "tests" and DETAIL_KEYS), each with its
+        "id" and "name" in the store.
+        """
+        conditions = []
+        arguments = []
+        for column, values in (("system_message_file", system_message_files), ("model", models),
+                               ("k", ks), ("metric", None if metric is None else [metric]),
+                               ("k_unit", None if k_unit is None else [k_unit]),
+                               ("parameters", None if parameters_configurations is None else
+                                [encode_parameters(parameters) for parameters in parameters_configurations])):
+            if values is not None:
+                conditions.append(column + " IN (" + ", ".join("?" for _ in values) + ")")
+                arguments.extend(values)
+        sql = "SELECT id, name, summary FROM report"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        res = []
+        for report_id, name, summary in self.conn.execute(sql + " ORDER BY k, name", arguments):
+            summary = json.loads(summary)
+            for key in DETAIL_KEYS + ("tests",):
+                summary.pop(key, None)
+            res.append(dict(summary, id=report_id, name=name))
+        return res
+
+    def get_scores(self, report_id):
+        """
+        Returns the test scores of a stored report, in test order.
+        """
+        return [row[0] for row in self.conn.execute(
+            "SELECT score FROM test_score WHERE report_id = ? ORDER BY position", (report_id,))]
+
+    def get_test_scores(self, report_id):
+        """
+        Returns the "input" and "score" of every test of a stored report, in test order, as dictionaries that
+        significance.align_scores accepts.
+        """
+        return [{"input": row[0], "score": row[1]} for row in self.conn.execute(
+            "SELECT json_extract(test, '$.input'), score FROM test_score WHERE report_id = ? ORDER BY position",
+            (report_id,))]
+
+    def load(self, name):
+        """
+        Returns the full report stored under a report name, tests included, or None if there is none.
+        """
+        row = self.conn.execute("SELECT id, summary, details FROM report WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return None
+        report = json.loads(row[1])
+        report.update(json.loads(row[2]))
+        report["tests"] = [json.loads(test[0]) for test in self.conn.execute(
+            "SELECT test FROM test_score WHERE report_id = ? ORDER BY position", (row[0],))]
+        return report
+
+    def names(self):
+        """
+        Returns the names of all stored reports.
+        """
+        return [row[0] for row in self.conn.execute("SELECT name FROM report ORDER BY name")]
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM report").fetchone()[0]
+
+    def import_json_reports(self, directory=None, missing_only=False):
+        """
+        Imports the JSON reports of a 'reports' directory, storing each under its file name without the .json
+        extension. Reports already in the store are replaced, or skipped if missing_only is True.
+
+        Parameters:
+        directory (str, optional): The directory to import. Defaults to the project's 'reports' subdirectory.
+        missing_only (bool, optional): Whether to import only the reports whose names are not in the store yet.
+            Defaults to False.
+
+        Returns:
+        int: The number of imported reports.
+        """
+        directory = directory or config.data_path(self.project, "reports")
+        if not os.path.isdir(directory):
+            return 0
+        stored = set(self.names()) if missing_only else set()
+        report_files = [report_file for report_file in os.listdir(directory)
+                        if report_file.endswith(".json") and report_file[:-len(".json")] not in stored]
+        for report_file in report_files:
+            with open(os.path.join(directory, report_file), "r", encoding="utf-8") as f:
+                self.save(report_file[:-len(".json")], json.load(f))
+        return len(report_files)
+
+    def export_json(self, directory=None, names=None):
+        """
+        Writes stored reports as JSON files named after their report names, in the format create_report has always
+        written, with create_reports.save_report.
+
+        Parameters:
+        directory (str, optional): The target directory. Defaults to the project's 'reports' subdirectory.
+        names (list of str, optional): The reports to export. Defaults to all of them.
+
+        Returns:
+        int: The number of exported reports.
+        """
+        import create_reports
+
+        directory = directory or config.data_path(self.project, "reports")
+        os.makedirs(directory, exist_ok=True)
+        names = self.names() if names is None else names
+        for name in names:
+            create_reports.save_report(os.path.join(directory, name + ".json"), self.load(name))
+        return len(names)
+
+    def close(self):
+        self.conn.close()
+
+
+if __name__ == "__main__":
+    for project in os.listdir(config.get_data_dir()):
+        if os.path.isdir(config.data_path(project, "reports")):
+            store = ReportStore(project)
+            print(f"{project}: imported {store.import_json_reports()} reports")
+            store.close()
@@ -0,0 +1,79 @@
+import json
+import os
+
+import config
+import create_reports
+import metrics
+import report_store
+
+
+def rescore(project, metric_names, processes=None, force=False):
+    """
+    Computes additional metrics for the existing reports of a project from the outputs stored in them, without
+    rebuilding prompts or calling the language model. All pending (report, metric) pairs are scored in one batch per
+    metric with metrics.metric_statistics, and only reports that changed are written back, to their JSON files and
+    to the report store.
+
+    For every new metric, each test gets test["scores"][metric] and the report gets report["scores"][metric] with the
+    average, median, std, percentiles and the corpus-level score. The primary metric of a report (report["metric"])
+    and metrics already present in report["scores"] are skipped unless force is True.
+
+    Parameters:
+    project (str): The name of the project whose 'reports' subdirectory is rescored.
+    metric_names (list of str): The metrics to compute, such as ["bleu", "chrf"].
+    processes (int, optional): The number of worker processes used for large batches. See metrics.calculate_metrics.
+    force (bool, optional): Whether to recompute metrics that are already present. Defaults to False.
+
+    Returns:
+    int: The number of (report, metric) pairs that were computed.
+    """
+    reports_directory = config.data_path(project, "reports")
+    report_files = [report_file for report_file in os.listdir(reports_directory) if report_file.endswith(".json")]
+    reports = {}
+    for report_file in report_files:
+        with open(os.path.join(reports_directory, report_file), "r", encoding="utf-8") as f:
+            reports[report_file] = json.load(f)
+
+    computed = 0
+    changed = set()
+    for metric in metric_names:
+        pending = [report_file for report_file in report_files
+                   if force or (metric != reports[report_file]["metric"] and
+                                metric not in reports[report_file].get("scores", {}))]
+        if not pending:
+            continue
+
+        expected_list = []
+        actual_list = []
+        for report_file in pending:
+            for test in reports[report_file]["tests"]:
+                expected_list.append(test["output"])
+                actual_list.append(test["llm_output"])
+        statistics = metrics.metric_statistics(expected_list, actual_list, metric, processes=processes)
+        scores = [float(score) for score in metrics.metric_scores(statistics, metric)]
+
+        position = 0
+        for report_file in pending:
+            report = reports[report_file]
+            tests = report["tests"]
+            for test, score in zip(tests, scores[position:position + len(tests)]):
+                test.setdefault("scores", {})[metric] = score
+            summary = metrics.summarize_scores(scores[position:position + len(tests)])
+            summary["corpus"] = float(metrics.metric_scores(
+                statistics[position:position + len(tests)].sum(axis=0, keepdims=True), metric)[0])
+            report.setdefault("scores", {})[metric] = summary
+            position += len(tests)
+            changed.add(report_file)
+            computed += 1
+
+    store = report_store.ReportStore(project)
+    for report_file in changed:
+        create_reports.save_report(os.path.join(reports_directory, report_file), reports[report_file])
+        store.save(report_file[:-len(".json")], reports[report_file])
+    store.close()
+    print(f"Rescored {computed} (report, metric) pairs in {len(changed)} of {len(report_files)} reports")
+    return computed
+
+
+if __name__ == "__main__":
+    rescore("translation", ["chrf"])
@@ -0,0 +1,166 @@
+from statistics import NormalDist
+
+import numpy as np
+
+# Default number of bootstrap resamples and permutations, and confidence level of the intervals.
+RESAMPLES = 10000
+CONFIDENCE = 0.95
+
+# Resamples are drawn in chunks of at most this many resample x example cells, to bound memory.
+CHUNK_CELLS = 10000000
+
+# The half-width of the confidence interval that needed_sample_size aims for by default.
+TARGET_MARGIN = 0.01
+
+
+def _resampled_means(values, resamples, rng):
+    # Means of resamples with replacement, drawn as index matrices of shape (chunk, len(values)).
+    chunk_size = max(1, CHUNK_CELLS // len(values))
+    res = []
+    for start in range(0, resamples, chunk_size):
+        indices = rng.integers(0, len(values), size=(min(chunk_size, resamples - start), len(values)))
+        res.append(values[indices].mean(axis=1))
+    return np.concatenate(res)
+
+
+def bootstrap_ci(scores, resamples=RESAMPLES, confidence=CONFIDENCE, seed=0):
+    """
+    Computes a percentile bootstrap confidence interval of the mean of a list of scores.
+
+    Parameters:
+    scores (list of float): The per-test scores.
+    resamples (int, optional): The number of bootstrap resamples. Defaults to RESAMPLES.
+    confidence (float, optional): The confidence level. Defaults to CONFIDENCE.
+    seed (int, optional): The seed of the resampling. Defaults to 0.
+
+    Returns:
+    tuple: The (low, high) bounds of the interval.
+    """
+    values = np.asarray(scores, dtype=float)
+    means = _resampled_means(values, resamples, np.random.default_rng(seed))
+    low, high = np.quantile(means, [(1 - confidence) / 2, (1 + confidence) / 2])
+    return float(low), float(high)
+
+
+def needed_sample_size(std, effect, alpha=1 - CONFIDENCE, power=None):
+    """
+    Estimates the number of test examples needed, using the normal approximation.
+
+    Without power, it is the number of examples for which the half-width of the (1 - alpha) confidence interval of
+    the mean of scores with standard deviation std is at most effect. With power, it is the number of paired
+    examples needed to detect a mean difference of effect between two prompts, whose differences have standard
+    deviation std, with a two-sided test at level alpha and the given power.
+
+    Returns:
+    int: The estimated sample size, or None if effect is 0.
+    """
+    if effect == 0:
+        return None
+    z = NormalDist().inv_cdf(1 - alpha / 2)
+    if power is not None:
+        z += NormalDist().inv_cdf(power)
+    return int(np.ceil((z * std / abs(effect)) ** 2))
+
+
+def summarize_confidence(scores, resamples=RESAMPLES, confidence=CONFIDENCE, margin=TARGET_MARGIN, seed=0):
+    """
+    Summarizes the uncertainty of the mean of a report's scores the way reports store it.
+
+    Returns:
+    dict: The "confidence_interval" ("confidence", "low" and "high", see bootstrap_ci) and the "needed_sample_size"
+    ("margin" and "n_tests", see needed_sample_size) for a confidence interval half-width of margin.
+    """
+    low, high = bootstrap_ci(scores, resamples, confidence, seed)
+    return {
+        "confidence_interval": {"confidence": confidence, "low": low, "high": high},
+        "needed_sample_size": {"margin": margin,
+                               "n_tests": needed_sample_size(float(np.std(scores, ddof=1)) if len(scores) > 1 else 0.0,
+                                                             margin, 1 - confidence)}
+    }
+
+
+def align_scores(tests_a, tests_b, metric=None):
+    """
+    Pairs the scores of two reports over the test examples they share, matched by their "input".
+
+    Parameters:
+    tests_a, tests_b (list of dict): The tests of the two reports.
+    metric (str, optional): The metric to pair; the primary score if None, test["scores"][metric] otherwise (see
+        rescore.rescore).
+
+    Returns:
+    tuple: Two NumPy arrays with the paired scores of a and b.
+    """
+
+    def score(test):
+        return test["score"] if metric is None else test["scores"][metric]
+
+    scores_b = {test["input"]: score(test) for test in tests_b}
+    pairs = [(score(test), scores_b[test["input"]]) for test in tests_a if test["input"] in scores_b]
+    if not pairs:
+        raise ValueError("The reports share no test examples")
+    res = np.asarray(pairs, dtype=float)
+    return res[:, 0], res[:, 1]
+
+
+def paired_test(scores_a, scores_b, resamples=RESAMPLES, confidence=CONFIDENCE, power=0.8, seed=0):
+    """
+    Compares two prompts evaluated on the same test examples. The p-value is that of a two-sided paired permutation
+    test (random sign flips of the per-example differences), and the confidence interval of the mean difference is
+    a percentile bootstrap interval. Both are computed over all resamples at once with NumPy.
+
+    Parameters:
+    scores_a, scores_b (list of float): The paired scores, as returned by align_scores.
+    resamples (int, optional): The number of permutations and of bootstrap resamples. Defaults to RESAMPLES.
+    confidence (float, optional): The confidence level of the interval; 1 - confidence is also the significance
+        level. Defaults to CONFIDENCE.
+    power (float, optional): The power used for the needed sample size. Defaults to 0.8.
+    seed (int, optional): The seed of the resampling. Defaults to 0.
+
+    Returns:
+    dict: The number of paired examples "n", the "mean_difference" (a - b), its "confidence_interval" ("low",
+    "high"), the "p_value", whether the difference is "significant", and the "needed_sample_size": the number of
+    paired examples needed to detect the observed difference with the given power.
+    """
+    differences = np.asarray(scores_a, dtype=float) - np.asarray(scores_b, dtype=float)
+    rng = np.random.default_rng(seed)
+    observed = differences.mean()
+
+    chunk_size = max(1, CHUNK_CELLS // len(differences))
+    extreme = 0
+    for start in range(0, resamples, chunk_size):
+        signs = rng.choice((-1.0, 1.0), size=(min(chunk_size, resamples - start), len(differences)))
+        extreme += int(np.count_nonzero(np.abs(signs @ differences) / len(differences) >= abs(observed) - 1e-12))
+    p_value = (extreme + 1) / (resamples + 1)
+
+    means = _resampled_means(differences, resamples, rng)
+    low, high = np.quantile(means, [(1 - confidence) / 2, (1 + confidence) / 2])
+    std = float(np.std(differences, ddof=1)) if len(differences) > 1 else 0.0
+    return {
+        "n": len(differences),
+        "mean_difference": float(observed),
+        "confidence_interval": {"confidence": confidence, "low": float(low), "high": float(high)},
+        "p_value": p_value,
+        "significant": p_value < 1 - confidence,
+        "needed_sample_size": needed_sample_size(std, observed, 1 - confidence, power)
+    }
+
+
+def compare_reports(report_a, report_b, metric=None, **kwargs):
+    """
+    Runs paired_test on the per-test scores of two full reports (with their "tests") over the test examples they
+    share. Further keyword arguments are passed on to paired_test.
+    """
+    scores_a, scores_b = align_scores(report_a["tests"], report_b["tests"], metric)
+    return paired_test(scores_a, scores_b, **kwargs)
+
+
+if __name__ == "__main__":
+    import report_store
+
+    store = report_store.ReportStore("grammar_correction")
+    reports = store.query(system_message_files=["4", "6"], models=["gpt-3.5-turbo"],
+                          parameters_configurations=[{"language": "English"}], ks=[2000], metric="bleu")
+    if len(reports) == 2:
+        print(compare_reports(store.load(reports[0]["name"]), store.load(reports[1]["name"])))
+    store.close()
@@ -0,0 +1,148 @@
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import cache as cache_module
+import config
+import create_reports
+import llm
+
+logger = logging.getLogger(__name__)
+
+
+def expand_spec(spec):
+    """
+    Expands a sweep spec into the list of report configurations it covers: the cross product of its system message
+    files, models, parameter configurations and ks.
+
+    Parameters:
+    spec (dict): A dictionary with the keys "project", "system_message_files", "models", "parameters" (a list of
+        parameter dictionaries), "ks", "metric" and, optionally, "n" (default 1) and "k_unit" ("chars" or "tokens",
+        default "chars").
+
+    Returns:
+    list of dict: The keyword arguments of one create_report call per configuration.
+    """
+    res = []
+    for system_message_file in spec["system_message_files"]:
+        for model in spec["models"]:
+            for parameters in spec["parameters"]:
+                for k in spec["ks"]:
+                    configuration = {
+                        "project": spec["project"],
+                        "model": model,
+                        "system_message_file": system_message_file,
+                        "parameters": parameters,
+                        "k": k,
+                        "metric": spec["metric"],
+                        "n": spec.get("n", 1)
+                    }
+                    if spec.get("k_unit", "chars") != "chars":
+                        configuration["k_unit"] = spec["k_unit"]
+                    res.append(configuration)
+    return res
+
+
+def get_configuration_id(configuration):
+    """
+    Returns the string that identifies a configuration in the sweep checkpoint.
+    """
+    return json.dumps(configuration, sort_keys=True, ensure_ascii=False)
+
+
+def run_sweep(specs, max_workers=8, checkpoint_path=None):
+    """
+    Runs every report of one or more sweep specs. The specs are expanded into configurations, the configurations
+    into the LLM calls of all their repetitions, and the calls are deduplicated globally, so a prompt shared by
+    several configurations or repetitions is sent once. Calls already in the cache are skipped and the remaining
+    ones run concurrently. As soon as all calls of a configuration are done, its report is written by
+    create_reports.create_report from the cache and the configuration is appended to the checkpoint file.
+
+    A killed sweep can be restarted with the same arguments: configurations in the checkpoint are skipped, and the
+    completions of finished calls are read back from the cache.
+
+    Parameters:
+    specs (list of dict): The sweep specs; see expand_spec.
+    max_workers (int, optional): The maximum number of concurrent LLM calls. Defaults to 8.
+    checkpoint_path (str, optional): The file recording finished configurations, one JSON line each. Defaults to
+        sweep_checkpoint.jsonl in the data directory.
+
+    Returns:
+    None. The reports are saved by create_reports.create_report.
+    """
+    checkpoint_path = checkpoint_path or config.data_path("sweep_checkpoint.jsonl")
+    configurations = {}
+    for spec in specs:
+        for configuration in expand_spec(spec):
+            configurations[get_configuration_id(configuration)] = configuration
+
+    finished = set()
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path, "r", encoding="utf-8") as f:
+            finished = set(line.rstrip("\n") for line in f if line.strip())
+    pending_configurations = [configuration_id for configuration_id in configurations
+                              if configuration_id not in finished]
+    logger.info("Sweep: %d configurations, %d already finished", len(configurations),
+                len(configurations) - len(pending_configurations))
+
+    cache = llm.get_chat_completion_cache()
+    call_parameters = {"temperature": create_reports.TEMPERATURE, "max_tokens": create_reports.MAX_TOKENS}
+    calls = {}
+    waiting = {}
+    for configuration_id in pending_configurations:
+        configuration = configurations[configuration_id]
+        waiting[configuration_id] = set()
+        for q in range(configuration["n"]):
+            prompt, test = create_reports.build_prompt(configuration["project"], configuration["system_message_file"],
+                                                       configuration["parameters"], configuration["k"], q,
+                                                       configuration.get("k_unit", "chars"))
+            for example in test:
+                messages = prompt + [{
+                    "role": "user",
+                    "content": example["input"]
+                }]
+                key = cache_module.make_key(configuration["model"], messages, call_parameters)
+                if key not in calls:
+                    if cache.get(configuration["model"], messages, call_parameters) is not None:
+                        continue
+                    calls[key] = (configuration["model"], messages, set())
+                calls[key][2].add(configuration_id)
+                waiting[configuration_id].add(key)
+    logger.info("Sweep: %d unique uncached calls for %d configurations", len(calls), len(pending_configurations))
+
+    def write_report(configuration_id):
+        configuration = configurations[configuration_id]
+        os.makedirs(config.data_path(configuration["project"], "reports"), exist_ok=True)
+        create_reports.create_report(cache=cache, **configuration)
+        cache.flush()
+        with open(checkpoint_path, "a", encoding="utf-8") as f:
+            f.write(configuration_id + "\n")
+
+    for configuration_id in pending_configurations:
+        if not waiting[configuration_id]:
+            write_report(configuration_id)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(llm.call_llm, cache, messages, model=model,
+                                   temperature=create_reports.TEMPERATURE, max_tokens=create_reports.MAX_TOKENS,
+                                   streaming=True): key
+                   for key, (model, messages, _) in calls.items()}
+        try:
+            for done, future in enumerate(as_completed(futures)):
+                future.result()
+                key = futures[future]
+                for configuration_id in calls[key][2]:
+                    waiting[configuration_id].discard(key)
+                    if not waiting[configuration_id]:
+                        write_report(configuration_id)
+                logger.info("Sweep: %d/%d calls done, %.2f calls/s", done + 1, len(calls),
+                            (done + 1) / (time.perf_counter() - start))
+        except BaseException:
+            # Cancel the queued calls so that a failed call or Ctrl-C stops the sweep after the calls in flight
+            # instead of waiting for all of them. Completed calls stay cached and the checkpoint lets it resume.
+            executor.shutdown(cancel_futures=True)
+            raise
+    cache.close()
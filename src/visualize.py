@@ -1,11 +1,11 @@
-import matplotlib.pyplot as plt
-import os
-import json
+import report_store
+import significance
 
 
-def visualize(project, system_message_files, models, parameters_configurations, ks, metric):
+def visualize(project, system_message_files, models, parameters_configurations, ks, metric, output=None,
+              k_unit="chars"):
     """
-    Generates a visualization for the given project using boxplots. The boxplots represent various statistical measures including the average, standard deviation, and median of the specified metric for different tests. The function sorts and filters the report files based on specified criteria including system messages, models, parameter configurations, and ks values.
+    Generates a visualization for the given project using boxplots. The boxplots represent various statistical measures including the average, standard deviation, and median of the specified metric for different tests. The reports are queried from the project's report store (see report_store.ReportStore) by system messages, models, parameter configurations, ks values, metric and k unit, sorted by k, and only their test scores are loaded. JSON reports of the project that are not in the store yet are imported into it first.
 
     Parameters:
     project : str
@@ -21,11 +21,17 @@ def visualize(project, system_message_files, models, parameters_configurations,
     A list of parameter configurations to include in the analysis.
 
     ks : list
-    A list of 'k' values to include in the analysis. 'k' is the maximim number of characters used in the prompt examples.
+    A list of 'k' values to include in the analysis. 'k' is the maximim number of characters (or tokens, see k_unit) used in the prompt examples.
 
     metric : str
     The name of the metric to be visualized. This metric will be used to measure the performance of the models.
 
+    output : str, optional
+    If given, the plot is saved to this file instead of being displayed.
+
+    k_unit : str, optional
+    The unit of the ks values, "chars" (default) or "tokens". Only reports with this unit are plotted.
+
     Returns:
     None. A boxplot is created and displayed.
 
@@ -35,11 +41,14 @@ def visualize(project, system_message_files, models, parameters_configurations,
     excluding outliers. The 'fliers' points represent outliers.
     The boxplot is color-coded and styled using 'ggplot' style.
 
-    The labels of the boxplots include the average, standard deviation, and median of the specified metric. If there are multiple system messages, models, parameter configurations, or ks values, these are also included in the labels.
+    The labels of the boxplots include the average, standard deviation, and median of the specified metric, the 95% bootstrap confidence interval of the average, and the p-value of a paired test against the report with the best average (see significance.paired_test). If there are multiple system messages, models, parameter configurations, or ks values, these are also included in the labels.
     """
 
-    report_files = os.listdir("..//data//" + project + "//reports//")
-    report_files.sort(key=lambda x: int(x.split(" ")[-2].replace("k=", "")))
+    import matplotlib.pyplot as plt
+
+    store = report_store.ReportStore(project)
+    store.import_json_reports(missing_only=True)
+    reports = store.query(system_message_files, models, parameters_configurations, ks, metric, k_unit)
 
     data = []
     labels = []
@@ -49,31 +58,36 @@ def visualize(project, system_message_files, models, parameters_configurations,
     parameter_configurations_set = set()
     ks_set = set()
 
-    for report_file in report_files:
-        report = json.load(open("..//data//" + project + "//reports//" + report_file, "r", encoding="utf-8"))
-        if report["metric"] == metric:
-            if report["system_message_file"] in system_message_files:
-                if report["model"] in models:
-                    if report["parameters"] in parameters_configurations:
-                        if report["k"] in ks:
-                            data_column = []
-                            for test in report["tests"]:
-                                data_column.append(test["score"])
-                            data.append(data_column)
-                            system_messages_set.add(report["system_message_file"])
-                            models_set.add(report["model"])
-                            string_parameter_list = ""
-                            keys = list(report["parameters"].keys())
-                            keys.sort()
-                            for i in range(len(keys)):
-                                string_parameter_list += (keys[i][0] + "=" + report["parameters"][keys[i]])
-                                if i < len(keys) - 1:
-                                    string_parameter_list += "; "
-                            parameter_configurations_set.add(string_parameter_list)
-                            ks_set.add(report["k"])
-                            labels.append(
-                                (report["system_message_file"], report["model"], string_parameter_list, report["k"],
-                                 report["average"], report["std"], report["median"]))
+    for report in reports:
+        data.append(store.get_scores(report["id"]))
+        system_messages_set.add(report["system_message_file"])
+        models_set.add(report["model"])
+        string_parameter_list = ""
+        keys = list(report["parameters"].keys())
+        keys.sort()
+        for i in range(len(keys)):
+            string_parameter_list += (keys[i][0] + "=" + report["parameters"][keys[i]])
+            if i < len(keys) - 1:
+                string_parameter_list += "; "
+        parameter_configurations_set.add(string_parameter_list)
+        ks_set.add(report["k"])
+        low, high = significance.bootstrap_ci(data[-1])
+        labels.append(
+            (report["system_message_file"], report["model"], string_parameter_list, report["k"],
+             report["average"], report["std"], report["median"], low, high))
+
+    p_values = [None] * len(reports)
+    if len(reports) > 1:
+        best = max(range(len(reports)), key=lambda i: reports[i]["average"])
+        best_tests = store.get_test_scores(reports[best]["id"])
+        for i, report in enumerate(reports):
+            if i != best:
+                try:
+                    p_values[i] = significance.paired_test(
+                        *significance.align_scores(store.get_test_scores(report["id"]), best_tests))["p_value"]
+                except ValueError:
+                    pass
+    store.close()
 
     common_label = project + "\n"
     if len(system_messages_set) == 1:
@@ -84,11 +98,16 @@ def visualize(project, system_message_files, models, parameters_configurations,
         common_label += "p={" + list(parameter_configurations_set)[0] + "} "
     if len(ks_set) == 1:
         common_label += "k=" + str(list(ks_set)[0]) + " "
+    if k_unit != "chars":
+        common_label += "k_unit=" + k_unit + " "
 
     string_labels = []
-    for label in labels:
+    for label, p_value in zip(labels, p_values):
         string_label = f"{label[4]:.3f} ± {label[5]:.3f}\n"
         string_label += f"med = {label[6]:.3f}\n"
+        string_label += f"CI [{label[7]:.3f}, {label[8]:.3f}]\n"
+        if p_value is not None:
+            string_label += f"p = {p_value:.3f} vs best\n"
         if len(system_messages_set) > 1:
             string_label += "system=" + label[0] + " "
         if len(models_set) > 1:
@@ -107,7 +126,12 @@ def visualize(project, system_message_files, models, parameters_configurations,
     plt.xticks([i for i in range(1, len(labels) + 1)], string_labels)
     plt.title(common_label)
     plt.ylabel(metric)
-    plt.show()
+    plt.tight_layout()
+    if output is None:
+        plt.show()
+    else:
+        plt.savefig(output)
+        plt.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,412 @@
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+import cache as cache_module
+import config
+import create_reports
+import llm
+import sweep
+
+logger = logging.getLogger(__name__)
+
+# How long a task stays leased without a heartbeat from its worker, in seconds. Running workers renew the leases of
+# their tasks every LEASE_SECONDS / 4 seconds (see renew_leases), so this is how soon the tasks of a dead worker are
+# handed to other workers, not a limit on the duration of a call.
+LEASE_SECONDS = 120
+
+# A task whose call failed this many times is marked as failed instead of being queued again.
+MAX_TASK_ATTEMPTS = 3
+
+
+def open_queue(path=None):
+    """
+    Opens the work queue database, creating its tables if they do not exist:
+
+    task: one row per unique LLM call, keyed by the hash of its cache key, with the model, messages and call
+        parameters as JSON, its status ("pending", "leased", "done" or "failed"), the worker holding it and the
+        expiry time of its lease.
+    configuration: one row per report configuration of the queued sweeps, with its status ("pending" or
+        "written").
+    configuration_task: which tasks a configuration waits for.
+    worker: one row per worker, with its host, process id, start time, last activity and completed tasks.
+
+    Workers on several hosts can share the database through a network filesystem that supports SQLite's file
+    locking, if the data directory is marked as shared (config.set_shared or PROMPT_GPT_SHARED_DATA_DIR=1): WAL mode,
+    used otherwise, does not work across hosts, so the queue and the cache then use a rollback journal.
+    """
+    conn = sqlite3.connect(path or config.data_path("work_queue.sqlite3"), timeout=60.0, isolation_level=None,
+                           check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=" + config.get_journal_mode())
+    conn.execute("CREATE TABLE IF NOT EXISTS task "
+                 "(key_hash TEXT PRIMARY KEY, model TEXT, messages TEXT, parameters TEXT, status TEXT, worker TEXT, "
+                 "lease_expires REAL, attempts INTEGER, error TEXT, enqueued REAL, completed REAL)")
+    conn.execute("CREATE INDEX IF NOT EXISTS task_status ON task (status, lease_expires)")
+    conn.execute("CREATE TABLE IF NOT EXISTS configuration "
+                 "(configuration_id TEXT PRIMARY KEY, configuration TEXT, status TEXT)")
+    conn.execute("CREATE TABLE IF NOT EXISTS configuration_task "
+                 "(configuration_id TEXT, key_hash TEXT, PRIMARY KEY (configuration_id, key_hash))")
+    conn.execute("CREATE INDEX IF NOT EXISTS configuration_task_key_hash ON configuration_task (key_hash)")
+    conn.execute("CREATE TABLE IF NOT EXISTS worker "
+                 "(worker TEXT PRIMARY KEY, host TEXT, pid INTEGER, started REAL, last_seen REAL, completed INTEGER)")
+    return conn
+
+
+def enqueue_sweep(conn, specs):
+    """
+    Adds the report configurations of sweep specs (see sweep.expand_spec) and their LLM calls to the queue. Calls
+    are deduplicated against the queue and the cache: a call already queued by any sweep, or already in the cache,
+    is not queued again.
+
+    Returns:
+    tuple: The number of new configurations and of new tasks.
+    """
+    completion_cache = llm.get_chat_completion_cache()
+    call_parameters = {"temperature": create_reports.TEMPERATURE, "max_tokens": create_reports.MAX_TOKENS}
+    now = time.time()
+    configurations = 0
+    tasks = 0
+    for spec in specs:
+        for configuration in sweep.expand_spec(spec):
+            configuration_id = sweep.get_configuration_id(configuration)
+            if conn.execute("SELECT 1 FROM configuration WHERE configuration_id = ?",
+                            (configuration_id,)).fetchone() is not None:
+                continue
+            rows = []
+            for q in range(configuration["n"]):
+                prompt, test = create_reports.build_prompt(configuration["project"],
+                                                           configuration["system_message_file"],
+                                                           configuration["parameters"], configuration["k"], q,
+                                                           configuration.get("k_unit", "chars"))
+                for example in test:
+                    messages = prompt + [{"role": "user", "content": example["input"]}]
+                    if completion_cache.get(configuration["model"], messages, call_parameters) is not None:
+                        continue
+                    key_hash = cache_module.hash_key(cache_module.make_key(configuration["model"], messages,
+                                                                           call_parameters))
+                    rows.append((key_hash, configuration["model"], json.dumps(messages, ensure_ascii=False),
+                                 json.dumps(call_parameters), now))
+            conn.execute("BEGIN IMMEDIATE")
+            cursor = conn.executemany("INSERT OR IGNORE INTO task (key_hash, model, messages, parameters, status, "
+                                      "attempts, enqueued) VALUES (?, ?, ?, ?, 'pending', 0, ?)", rows)
+            tasks += max(cursor.rowcount, 0)
+            conn.executemany("INSERT OR IGNORE INTO configuration_task (configuration_id, key_hash) VALUES (?, ?)",
+                             [(configuration_id, row[0]) for row in rows])
+            conn.execute("INSERT INTO configuration (configuration_id, configuration, status) "
+                         "VALUES (?, ?, 'pending')", (configuration_id, json.dumps(configuration, ensure_ascii=False)))
+            conn.execute("COMMIT")
+            configurations += 1
+    completion_cache.close()
+    return configurations, tasks
+
+
+def lease_task(conn, worker, lease_seconds=LEASE_SECONDS):
+    """
+    Atomically leases the oldest pending task, or a task whose lease has expired because its worker crashed or
+    stalled, to a worker.
+
+    Returns:
+    tuple: The (key_hash, model, messages, parameters) of the task, or None if there is nothing to do.
+    """
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute("SELECT key_hash, model, messages, parameters FROM task "
+                           "WHERE status = 'pending' OR (status = 'leased' AND lease_expires < ?) "
+                           "ORDER BY enqueued LIMIT 1", (now,)).fetchone()
+        if row is not None:
+            conn.execute("UPDATE task SET status = 'leased', worker = ?, lease_expires = ? WHERE key_hash = ?",
+                         (worker, now + lease_seconds, row[0]))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    if row is None:
+        return None
+    return row[0], row[1], json.loads(row[2]), json.loads(row[3])
+
+
+def renew_leases(conn, worker, key_hashes, lease_seconds=LEASE_SECONDS):
+    """
+    Extends the leases of the given tasks, where the worker still holds them, by lease_seconds from now. Returns the
+    number of renewed leases.
+    """
+    expires = time.time() + lease_seconds
+    return conn.executemany("UPDATE task SET lease_expires = ? WHERE key_hash = ? AND worker = ? AND status = 'leased'",
+                            [(expires, key_hash, worker) for key_hash in key_hashes]).rowcount
+
+
+def release_task(conn, worker, key_hash):
+    """
+    Queues a task the worker holds again without counting an attempt, for failures that are not the call's fault,
+    such as a locked database. Returns whether the worker still held the task.
+    """
+    return conn.execute("UPDATE task SET status = 'pending', worker = NULL "
+                        "WHERE key_hash = ? AND worker = ? AND status = 'leased'", (key_hash, worker)).rowcount > 0
+
+
+def finish_task(conn, worker, key_hash, error=None):
+    """
+    Marks a leased task as done, or, if error is given, queues it again (or marks it as failed after
+    MAX_TASK_ATTEMPTS attempts or on a fatal error, see llm.classify_error). Tasks whose lease has meanwhile passed to
+    another worker are left alone. Updates the worker's activity.
+
+    Returns:
+    bool: Whether the worker still held the task. If not, its result was not recorded; the completion is in the
+    cache anyway, so the worker now holding the task finds it there.
+    """
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if error is None:
+            updated = conn.execute("UPDATE task SET status = 'done', completed = ? "
+                                   "WHERE key_hash = ? AND worker = ? AND status = 'leased'",
+                                   (now, key_hash, worker)).rowcount
+        else:
+            fatal = llm.classify_error(error) == "fatal"
+            updated = conn.execute("UPDATE task SET attempts = attempts + 1, error = ?, worker = NULL, "
+                                   "status = CASE WHEN ? OR attempts + 1 >= ? THEN 'failed' ELSE 'pending' END "
+                                   "WHERE key_hash = ? AND worker = ? AND status = 'leased'",
+                                   (str(error), fatal, MAX_TASK_ATTEMPTS, key_hash, worker)).rowcount
+        conn.execute("UPDATE worker SET last_seen = ?, completed = completed + ? WHERE worker = ?",
+                     (now, 1 if error is None and updated else 0, worker))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return updated > 0
+
+
+def run_worker(queue_path=None, worker=None, threads=4, lease_seconds=LEASE_SECONDS,
+               idle_timeout=None, poll_interval=2.0):
+    """
+    Runs a worker: threads threads lease tasks from the queue, call the model with llm.call_llm and write the
+    completions to the shared cache. A completion is flushed to the cache database before its task is marked as
+    done, so a task is only done once its completion is visible to every process. A heartbeat thread renews the
+    leases of the tasks in progress every lease_seconds / 4 seconds, so slow calls keep their tasks; if the worker
+    dies, its leased tasks are handed to other workers when their leases expire.
+
+    Database errors of the queue or the cache (such as "database is locked" on a busy shared cache) do not stop a
+    thread or count as failed calls: the task is queued again, or, if even that fails, its lease is no longer renewed
+    and expires.
+
+    Parameters:
+    queue_path (str, optional): The path of the queue database. Defaults to work_queue.sqlite3 in the data
+        directory.
+    worker (str, optional): The name of the worker. Defaults to "<host>-<pid>-<random suffix>".
+    threads (int, optional): The number of concurrent calls. Defaults to 4.
+    lease_seconds (float, optional): The lease duration. Defaults to LEASE_SECONDS.
+    idle_timeout (float, optional): Stop after this many seconds without work. Defaults to None (run forever).
+    poll_interval (float, optional): How long to wait when the queue is empty, in seconds. Defaults to 2.0.
+
+    Returns:
+    int: The number of tasks this worker completed.
+    """
+    worker = worker or socket.gethostname() + "-" + str(os.getpid()) + "-" + uuid.uuid4().hex[:6]
+    conn = open_queue(queue_path)
+    conn.execute("INSERT OR REPLACE INTO worker (worker, host, pid, started, last_seen, completed) "
+                 "VALUES (?, ?, ?, ?, ?, 0)", (worker, socket.gethostname(), os.getpid(), time.time(), time.time()))
+    conn.close()
+    completion_cache = llm.get_chat_completion_cache()
+    completed = [0]
+    in_progress = set()
+    lock = threading.Lock()
+
+    def release(thread_conn, key_hash):
+        try:
+            release_task(thread_conn, worker, key_hash)
+        except sqlite3.Error as e:
+            logger.warning("Worker %s could not queue task %s again, its lease expires within %.0fs: %s", worker,
+                           key_hash[:12], lease_seconds, e)
+
+    def run_task(thread_conn, key_hash, model, messages, parameters):
+        error = None
+        try:
+            llm.call_llm(completion_cache, messages, model=model, temperature=parameters["temperature"],
+                         max_tokens=parameters["max_tokens"])
+            completion_cache.flush()
+        except sqlite3.OperationalError as e:
+            # The queue or the cache was locked or busy, which says nothing about the call: queue the task again
+            # without counting an attempt. A completion already written is found in the cache on the next lease.
+            logger.warning("Task %s hit a database error on worker %s, queueing it again: %s", key_hash[:12], worker,
+                           e)
+            release(thread_conn, key_hash)
+            return
+        except Exception as e:
+            logger.warning("Task %s failed on worker %s: %s", key_hash[:12], worker, e)
+            error = e
+        try:
+            held = finish_task(thread_conn, worker, key_hash, error)
+        except sqlite3.Error as e:
+            logger.warning("Worker %s could not record task %s: %s", worker, key_hash[:12], e)
+            release(thread_conn, key_hash)
+            return
+        if not held:
+            logger.warning("Task %s was handed to another worker before worker %s finished it", key_hash[:12],
+                           worker)
+        elif error is None:
+            with lock:
+                completed[0] += 1
+
+    def work():
+        thread_conn = open_queue(queue_path)
+        idle_since = time.monotonic()
+        while True:
+            try:
+                task = lease_task(thread_conn, worker, lease_seconds)
+            except sqlite3.Error as e:
+                logger.warning("Worker %s could not lease a task: %s", worker, e)
+                time.sleep(poll_interval)
+                continue
+            if task is None:
+                if idle_timeout is not None and time.monotonic() - idle_since > idle_timeout:
+                    break
+                time.sleep(poll_interval)
+                continue
+            key_hash, model, messages, parameters = task
+            with lock:
+                in_progress.add(key_hash)
+            try:
+                run_task(thread_conn, key_hash, model, messages, parameters)
+            finally:
+                with lock:
+                    in_progress.discard(key_hash)
+            idle_since = time.monotonic()
+        thread_conn.close()
+
+    stopped = threading.Event()
+
+    def heartbeat():
+        heartbeat_conn = open_queue(queue_path)
+        while not stopped.wait(lease_seconds / 4):
+            with lock:
+                key_hashes = list(in_progress)
+            try:
+                renew_leases(heartbeat_conn, worker, key_hashes, lease_seconds)
+            except sqlite3.Error as e:
+                logger.warning("Renewing the leases of worker %s failed: %s", worker, e)
+        heartbeat_conn.close()
+
+    heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+    heartbeat_thread.start()
+    worker_threads = [threading.Thread(target=work) for _ in range(threads)]
+    for thread in worker_threads:
+        thread.start()
+    for thread in worker_threads:
+        thread.join()
+    stopped.set()
+    heartbeat_thread.join()
+    completion_cache.close()
+    logger.info("Worker %s completed %d tasks", worker, completed[0])
+    return completed[0]
+
+
+def get_progress(conn, window=60.0):
+    """
+    Returns the state of the queue: the number of tasks per status, and per worker its host, completed tasks,
+    average throughput since it started and throughput over the last window seconds (tasks per second), and the
+    time since it was last active.
+    """
+    now = time.time()
+    res = {
+        "tasks": dict(conn.execute("SELECT status, COUNT(*) FROM task GROUP BY status").fetchall()),
+        "workers": {}
+    }
+    recent = dict(conn.execute("SELECT worker, COUNT(*) FROM task WHERE status = 'done' AND completed > ? "
+                               "GROUP BY worker", (now - window,)).fetchall())
+    for worker, host, started, last_seen, completed in conn.execute(
+            "SELECT worker, host, started, last_seen, completed FROM worker ORDER BY started"):
+        res["workers"][worker] = {
+            "host": host,
+            "completed": completed,
+            "throughput": completed / max(last_seen - started, 1e-9),
+            "recent_throughput": recent.get(worker, 0) / window,
+            "idle_seconds": now - last_seen
+        }
+    return res
+
+
+def write_finished_reports(conn):
+    """
+    Writes, with create_reports.create_report, the report of every pending configuration whose tasks are all done,
+    and marks it as written. Returns the number of reports written.
+    """
+    rows = conn.execute("SELECT configuration_id, configuration FROM configuration WHERE status = 'pending' AND "
+                        "NOT EXISTS (SELECT 1 FROM configuration_task JOIN task USING (key_hash) WHERE "
+                        "configuration_task.configuration_id = configuration.configuration_id AND "
+                        "task.status != 'done')").fetchall()
+    if not rows:
+        return 0
+    completion_cache = llm.get_chat_completion_cache()
+    for configuration_id, configuration in rows:
+        configuration = json.loads(configuration)
+        os.makedirs(config.data_path(configuration["project"], "reports"), exist_ok=True)
+        create_reports.create_report(cache=completion_cache, **configuration)
+        conn.execute("UPDATE configuration SET status = 'written' WHERE configuration_id = ?", (configuration_id,))
+    completion_cache.close()
+    return len(rows)
+
+
+def run_coordinator(specs, queue_path=None, poll_interval=10.0):
+    """
+    Queues the LLM calls of sweep specs and then watches the queue until every configuration is done: it logs the
+    task counts and the progress and throughput of each worker, and writes each report as soon as all its calls
+    are done. Workers are started separately with run_worker, on this host or on others that share the data
+    directory (see open_queue). The coordinator can be stopped and restarted at any time; queued work is kept.
+
+    Configurations that wait for a failed task are reported and left pending.
+
+    Parameters:
+    specs (list of dict): The sweep specs; see sweep.expand_spec.
+    queue_path (str, optional): The path of the queue database. Defaults to work_queue.sqlite3 in the data
+        directory.
+    poll_interval (float, optional): Seconds between progress updates. Defaults to 10.0.
+    """
+    conn = open_queue(queue_path)
+    configurations, tasks = enqueue_sweep(conn, specs)
+    logger.info("Queued %d new configurations and %d new tasks", configurations, tasks)
+    while True:
+        unfinished = conn.execute("SELECT COUNT(*) FROM task WHERE status IN ('pending', 'leased')").fetchone()[0]
+        written = write_finished_reports(conn)
+        if written:
+            logger.info("Wrote %d reports", written)
+        progress = get_progress(conn)
+        logger.info("Tasks: %s", ", ".join(status + "=" + str(count)
+                                           for status, count in sorted(progress["tasks"].items())))
+        for worker, state in progress["workers"].items():
+            logger.info("Worker %s on %s: %d done, %.2f tasks/s overall, %.2f tasks/s recently, idle %.0fs", worker,
+                        state["host"], state["completed"], state["throughput"], state["recent_throughput"],
+                        state["idle_seconds"])
+        pending = conn.execute("SELECT COUNT(*) FROM configuration WHERE status = 'pending'").fetchone()[0]
+        if pending == 0:
+            break
+        if unfinished == 0:
+            logger.error("%d configurations wait for failed tasks", pending)
+            break
+        time.sleep(poll_interval)
+    conn.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    parser = argparse.ArgumentParser(description="Runs a work queue worker, or a coordinator for a sweep spec file.")
+    parser.add_argument("role", choices=["worker", "coordinator"])
+    parser.add_argument("--specs", help="JSON file with a list of sweep specs (coordinator)")
+    parser.add_argument("--threads", type=int, default=4, help="concurrent calls (worker)")
+    parser.add_argument("--shared", action="store_true",
+                        help="the data directory is shared by several hosts (no WAL mode, see open_queue)")
+    arguments = parser.parse_args()
+    if arguments.shared:
+        config.set_shared(True)
+    if arguments.role == "worker":
+        run_worker(threads=arguments.threads)
+    else:
+        with open(arguments.specs, "r", encoding="utf-8") as f:
+            run_coordinator(json.load(f))